@@ -0,0 +1,446 @@
+import argparse
+import glob
+import os
+import sys
+import time
+import char_normalizer as cn
+import phrase_normalizer as pn
+import toolkit as tk
+import word_normalizer as wn
+from converter import (LazyTSV, TSV2dict, TSV2table, data_path, dict2TSV, iter_TSV, stream2TSV,
+                       tee2TSV)
+
+
+def stage_paths(style, compress=None, columnar=False):
+    """
+    Return the paths of the files read and written by each normalization stage.
+
+    The c_norm, w_norm and p_norm paths are given by data_path, so they end in
+    .gz, .xz or .zst if compress is set, or in .adpc if columnar is True.
+    """
+    output_dir = os.path.join(style, "output_files")
+    return {
+        "char_review": os.path.join(output_dir, "char_review.tsv"),
+        "char_reference": os.path.join(output_dir, "char_reference.tsv"),
+        "c_norm": data_path(os.path.join(output_dir, f"c_norm_{style}.tsv"), compress, columnar),
+        "word_review": os.path.join(output_dir, "word_review.tsv"),
+        "word_reference": os.path.join(output_dir, "word_reference.tsv"),
+        "w_norm": data_path(os.path.join(output_dir, f"w_norm_{style}.tsv"), compress, columnar),
+        "phrase_types": os.path.join(output_dir, f"{style}_phrase_types.tsv"),
+        "p_norm": data_path(os.path.join(output_dir, f"p_norm_{style}.tsv"), compress, columnar),
+        "cache": os.path.join(output_dir, "cache"),
+    }
+
+
+def open_stage_cache(style, filename, paths, intermediates, settings):
+    """
+    Return a tk.StageCache in the cache folder of paths, the key of a run on
+    the input file with the given settings, and the files that run writes.
+    """
+    sheets = [paths["char_review"], paths["char_reference"], paths["word_review"],
+              paths["word_reference"], paths["phrase_types"]]
+    outputs = [paths["p_norm"], *sheets]
+    if intermediates:
+        outputs += [paths["c_norm"], paths["w_norm"]]
+    stage_cache = tk.StageCache(paths["cache"])
+    key = stage_cache.key("run", [os.path.join(style, "input_files", filename), *sheets],
+                          outputs, settings, [sys.modules[__name__], cn, wn, pn, pn.dls])
+    return stage_cache, key, outputs
+
+
+def run(style, filename, column, engine="regex", dedup=False, weight_column=None,
+        intermediates=False, workers=1, compress=None, columnar=False, incremental=False,
+        stage_cache=False, memo_path=None, data_dict=None):
+    """
+    Run the character, word and phrase stages on a dataset in one process.
+
+    Reads the input file once and hands the rows from stage to stage in memory,
+    writing only the phrase-normalized output and the review & reference files.
+    If intermediates is True, the c_norm and w_norm files are written as well.
+    If workers is more than 1, each stage shares its rows among that many
+    processes; the output and review files are the same as with one.
+    If compress is "gz", "xz" or "zst", the data files are written compressed;
+    if columnar is True, they are written in the binary columnar format.
+    If incremental is True, each stage keeps its results in the cache folder
+    and reuses them for values whose rules haven't changed since the last run.
+    If stage_cache is True, the files written are kept in a tk.StageCache in
+    the cache folder, and restored from it instead of running the stages when
+    the input file, sheets and settings match an earlier run.
+    If memo_path is given, each stage looks its values up in and adds them to
+    the SQLite database at that path, keyed by style and the stage's rules.
+    If data_dict is given, it is used as the rows of filename instead of
+    reading the file, and is changed in place.
+    Returns the tk.file_stat of each sheet written, by path, taken just after
+    it was written.
+    """
+    paths = stage_paths(style, compress, columnar)
+    if stage_cache:
+        settings = (column, engine, dedup, weight_column, incremental)
+        cache, key, outputs = open_stage_cache(style, filename, paths, intermediates, settings)
+        if cache.restore(key, outputs):
+            return {path: tk.file_stat(path) for path in outputs}
+    cache_dir = paths["cache"] if incremental else None
+    if data_dict is None:
+        data_dict = TSV2table(os.path.join(style, "input_files", filename))
+
+    review_dict, reference_dict = tk.load_sheets(paths["char_review"], paths["char_reference"])
+    data_dict, review_dict, reference_dict = cn.normalize_char_data(style,
+                                                                    data_dict,
+                                                                    column,
+                                                                    review_dict,
+                                                                    reference_dict,
+                                                                    engine,
+                                                                    dedup,
+                                                                    weight_column,
+                                                                    workers,
+                                                                    cache_dir,
+                                                                    memo_path)
+    written = tk.write_sheets(review_dict, paths["char_review"], reference_dict,
+                              paths["char_reference"])
+    if intermediates:
+        dict2TSV(data_dict, paths["c_norm"])
+
+    review_dict, reference_dict = tk.load_sheets(paths["word_review"], paths["word_reference"])
+    data_dict, review_dict, reference_dict = wn.normalize_word_data(style,
+                                                                    data_dict,
+                                                                    column,
+                                                                    review_dict,
+                                                                    reference_dict,
+                                                                    dedup,
+                                                                    weight_column,
+                                                                    workers,
+                                                                    cache_dir,
+                                                                    memo_path)
+    written.update(tk.write_sheets(review_dict, paths["word_review"], reference_dict,
+                                   paths["word_reference"]))
+    if intermediates:
+        dict2TSV(data_dict, paths["w_norm"])
+
+    if not os.path.isfile(paths["phrase_types"]):
+        pn.create_phrase_type_sheet(paths["phrase_types"])
+        written[paths["phrase_types"]] = tk.file_stat(paths["phrase_types"])
+    type_dict = TSV2dict(paths["phrase_types"])
+    data_dict = pn.normalize_phrase_data(style,
+                                         data_dict,
+                                         column,
+                                         type_dict,
+                                         review_dict,
+                                         reference_dict,
+                                         dedup,
+                                         workers,
+                                         cache_dir,
+                                         memo_path)
+    dict2TSV(data_dict, paths["p_norm"])
+    if stage_cache:
+        cache.store(key, outputs)
+    return written
+
+
+def run_stream(style, filename, column, engine="regex", dedup=False, weight_column=None,
+               intermediates=False, workers=1, compress=None, columnar=False,
+               incremental=False, stage_cache=False, memo_path=None):
+    """
+    Run the character, word and phrase stages as a single stream of rows.
+
+    Each row is read, passed through all three stages and written out before
+    the next one is read, so only the rule sheets and review entries stay in
+    memory. The review & reference files are written once the stream ends.
+    Columnar files need the whole table, so columnar must be False.
+    See run for the other arguments.
+    """
+    if columnar:
+        raise ValueError("Columnar files can't be written from a stream of rows.")
+    paths = stage_paths(style, compress)
+    if stage_cache:
+        settings = (column, engine, dedup, weight_column, incremental)
+        cache, key, outputs = open_stage_cache(style, filename, paths, intermediates, settings)
+        if cache.restore(key, outputs):
+            return
+    cache_dir = paths["cache"] if incremental else None
+    char_review, char_reference = tk.load_sheets(paths["char_review"], paths["char_reference"])
+    word_review, word_reference = tk.load_sheets(paths["word_review"], paths["word_reference"])
+    if not os.path.isfile(paths["phrase_types"]):
+        pn.create_phrase_type_sheet(paths["phrase_types"])
+    type_dict = TSV2dict(paths["phrase_types"])
+
+    rows = iter_TSV(os.path.join(style, "input_files", filename))
+    rows = cn.iter_normalize_chars(style,
+                                   rows,
+                                   column,
+                                   char_review,
+                                   char_reference,
+                                   engine,
+                                   dedup,
+                                   weight_column,
+                                   workers,
+                                   cache_dir,
+                                   memo_path)
+    if intermediates:
+        rows = tee2TSV(rows, paths["c_norm"])
+    rows = wn.iter_normalize_words(style,
+                                   rows,
+                                   column,
+                                   word_review,
+                                   word_reference,
+                                   dedup,
+                                   weight_column,
+                                   workers,
+                                   cache_dir,
+                                   memo_path)
+    if intermediates:
+        rows = tee2TSV(rows, paths["w_norm"])
+    rows = pn.iter_normalize_phrase(style,
+                                    rows,
+                                    column,
+                                    type_dict,
+                                    word_review,
+                                    word_reference,
+                                    dedup,
+                                    workers,
+                                    cache_dir,
+                                    memo_path)
+    stream2TSV(rows, paths["p_norm"])
+    tk.write_sheets(char_review, paths["char_review"], char_reference, paths["char_reference"])
+    tk.write_sheets(word_review, paths["word_review"], word_reference, paths["word_reference"])
+    if stage_cache:
+        cache.store(key, outputs)
+
+
+class Normalizer:
+    """
+    A style's rules, read once from its review, reference and phrase type
+    sheets, for normalizing strings in memory without data files.
+
+    normalize(string) runs a string through the character, word and phrase
+    stages and returns its output rows as dicts with the same columns as the
+    p_norm file, column being the name of the input column. There is one row
+    per phrase, so more than one if a data_loc value is split into phrases.
+    normalize_batch does the same for an iterable of strings.
+
+    The sheets are never written; unknown characters and words are logged
+    to char_review and word_review in memory. If memo_path is given, results
+    are looked up in and added to a tk.MemoStore there, which is written by
+    close.
+    """
+
+    def __init__(self, style, column="value", engine="regex", memo_path=None):
+        paths = stage_paths(style)
+        self.column = column
+        review_dict, reference_dict = tk.load_sheets(paths["char_review"],
+                                                     paths["char_reference"])
+        self.char_stage = cn.CharStage(style, column, review_dict, reference_dict, engine,
+                                       memo_path=memo_path)
+        review_dict, reference_dict = tk.load_sheets(paths["word_review"],
+                                                     paths["word_reference"])
+        self.word_stage = wn.WordStage(style, column, review_dict, reference_dict,
+                                       memo_path=memo_path)
+        if os.path.isfile(paths["phrase_types"]):
+            type_dict = TSV2dict(paths["phrase_types"])
+        else:
+            type_dict = {}
+        self.phrase_stage = pn.PhraseStage(style, column, type_dict,
+                                           self.word_stage.reference_dict, memo_path=memo_path)
+
+    @property
+    def char_review(self):
+        return self.char_stage.review_dict
+
+    @property
+    def word_review(self):
+        return self.word_stage.review_dict
+
+    def normalize(self, string):
+        """
+        Return the output rows of string.
+        """
+        return self.normalize_batch([string])[0]
+
+    def normalize_batch(self, strings):
+        """
+        Return a list of the output rows of each string in strings.
+        """
+        strings = list(strings)
+        rows = ((index, {"index": index, self.column: string})
+                for index, string in enumerate(strings))
+        rows = ((index, self.char_stage.process(index, rowdict)[0]) for index, rowdict in rows)
+        rows = ((index, self.word_stage.process(index, rowdict)[0]) for index, rowdict in rows)
+        results = [[] for string in strings]
+        for index, rowdict in self.phrase_stage.iter_rows(rows):
+            # data_loc rows are split into phrases, numbered apart from the strings
+            results[rowdict.get("original_index", index)].append(dict(rowdict))
+        return results
+
+    def close(self):
+        """
+        Write the memo store, if any. The Normalizer can't be used after.
+        """
+        self.char_stage.save()
+        self.word_stage.save()
+        self.phrase_stage.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def watched_files(style, filename):
+    """
+    Return the modification time and size of the input file and each review,
+    reference and phrase type sheet of style, by path.
+    """
+    output_dir = os.path.join(style, "output_files")
+    paths = [os.path.join(style, "input_files", filename)]
+    for pattern in ["*_review.tsv", "*_reference.tsv", "*_phrase_types.tsv"]:
+        paths += glob.glob(os.path.join(output_dir, pattern))
+    return {path: tk.file_stat(path) for path in paths}
+
+
+def watch(style, filename, column, engine="regex", dedup=False, weight_column=None,
+          intermediates=False, compress=None, columnar=False, memo_path=None, interval=1.0):
+    """
+    Run the stages on a dataset, then run them again each time a review,
+    reference or phrase type sheet is saved, until interrupted.
+
+    The input rows and each stage's result cache stay in memory between runs,
+    so a run after an edit only normalizes the values whose rules changed.
+    The sheets are checked for changes every interval seconds. If the input
+    file changes, it is read again. See run for the other arguments.
+    """
+    input_path = os.path.join(style, "input_files", filename)
+    table, input_stat = None, None
+    last_seen = {}
+    try:
+        while True:
+            seen = watched_files(style, filename)
+            if seen != last_seen:
+                changed = sorted(path for path in seen.keys() | last_seen.keys()
+                                 if seen.get(path) != last_seen.get(path))
+                if last_seen:
+                    print(f"Changed: {', '.join(changed)}")
+                start = time.perf_counter()
+                try:
+                    if seen[input_path] != input_stat:
+                        table, input_stat = TSV2table(input_path), seen[input_path]
+                    written = run(style, filename, column, engine, dedup, weight_column,
+                                  intermediates, 1, compress, columnar, True, False, memo_path,
+                                  table.copy())
+                    print(f"Normalized in {time.perf_counter() - start:.2f} s; "
+                          "watching for changes, press Ctrl+C to stop.")
+                    # Files saved during the run still differ from the snapshot taken
+                    # before it, unless the run wrote them itself since
+                    last_seen = {**seen, **written}
+                except Exception as error:
+                    # A sheet may be saved half-written, so wait for the next save
+                    print(f"Normalizing failed: {error!r}")
+                    last_seen = watched_files(style, filename)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+
+def show_rows(path, positions):
+    """
+    Print the rows of an uncompressed TSV at the given positions, counting
+    from 0, reading only those rows through the file's line index. Raises
+    IndexError before printing anything if a position is negative or past the
+    last row.
+    """
+    with LazyTSV(path) as table:
+        for position in positions:
+            if not 0 <= position < len(table):
+                raise IndexError(f"{path} has {len(table)} rows, so there is no row {position}")
+        for position in positions:
+            index, row = table.row(position)
+            print(f"row {position} (index {index})")
+            for key, value in row.items():
+                print(f"  {key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run ADP normalization stages.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run",
+                                       help="Run all three normalization stages in memory")
+    run_parser.add_argument("style",
+                            help="Data style, e.g., age or data_loc")
+    run_parser.add_argument("filename",
+                            help="Name of the TSV in <style>/input_files, e.g., age.tsv")
+    run_parser.add_argument("column",
+                            help="Name of the column to normalize, e.g., h_age")
+    run_parser.add_argument("--engine", "-e", choices=["regex", "translate"], default="regex",
+                            help="How character rules are applied")
+    run_parser.add_argument("--weights", "-w",
+                            help="Column holding the number of occurrences each row stands for")
+    run_parser.add_argument("--intermediates", "-i", action="store_true",
+                            help="Also write the c_norm and w_norm files")
+    run_parser.add_argument("--stream", "-s", action="store_true",
+                            help="Pass rows through the stages one at a time to keep memory flat")
+    run_parser.add_argument("--workers", "-j", type=int, default=1,
+                            help="Number of processes to share each stage's rows among")
+    tk.add_stage_arguments(run_parser)
+    watch_parser = subparsers.add_parser("watch",
+                                         help="Normalize again each time a rule sheet is saved")
+    watch_parser.add_argument("style",
+                              help="Data style, e.g., age or data_loc")
+    watch_parser.add_argument("column",
+                              help="Name of the column to normalize, e.g., h_age")
+    watch_parser.add_argument("--file", "-f",
+                              help="Name of the TSV in <style>/input_files, by default <style>.tsv")
+    watch_parser.add_argument("--engine", "-e", choices=["regex", "translate"], default="regex",
+                              help="How character rules are applied")
+    watch_parser.add_argument("--weights", "-w",
+                              help="Column holding the number of occurrences each row stands for")
+    watch_parser.add_argument("--intermediates", "-i", action="store_true",
+                              help="Also write the c_norm and w_norm files")
+    tk.add_stage_arguments(watch_parser, cache=False)
+    watch_parser.add_argument("--interval", type=float, default=1.0,
+                              help="Seconds between checks for changed sheets")
+    show_parser = subparsers.add_parser("show",
+                                        help="Print rows of a TSV without reading the whole file")
+    show_parser.add_argument("path",
+                             help="Path of an uncompressed TSV to read")
+    show_parser.add_argument("positions", nargs="+", type=int,
+                             help="Positions of the rows to print, counting from 0")
+    prune_parser = subparsers.add_parser("prune",
+                                         help="Delete runs stored in a style's output cache")
+    prune_parser.add_argument("style",
+                              help="Data style, e.g., age or data_loc")
+    prune_parser.add_argument("--max-size", type=float,
+                              help="Megabytes of runs to keep, most recently used first")
+    prune_parser.add_argument("--max-age", type=float,
+                              help="Also delete runs not used in this many days")
+    args = parser.parse_args()
+    if args.command == "run" and args.stream and args.columnar:
+        run_parser.error("--columnar can't be used with --stream")
+    if args.command == "run" and args.incremental and args.workers > 1:
+        run_parser.error("--incremental can't be used with more than one worker")
+    if args.command == "run" and args.memo and args.workers > 1:
+        run_parser.error("--memo can't be used with more than one worker")
+    if args.command == "run":
+        runner = run_stream if args.stream else run
+        runner(args.style, args.filename, args.column, args.engine, args.dedup, args.weights,
+               args.intermediates, args.workers, args.compress, args.columnar,
+               args.incremental, not args.no_cache, args.memo)
+    elif args.command == "watch":
+        watch(args.style, args.file or f"{args.style}.tsv", args.column, args.engine, args.dedup,
+              args.weights, args.intermediates, args.compress, args.columnar, args.memo,
+              args.interval)
+    elif args.command == "show":
+        try:
+            show_rows(args.path, args.positions)
+        except IndexError as error:
+            show_parser.error(str(error))
+    elif args.command == "prune":
+        # With neither limit given, every stored run is deleted
+        max_size = 0 if args.max_size is None and args.max_age is None else args.max_size
+        max_bytes = None if max_size is None else max_size * 1024 * 1024
+        max_age = None if args.max_age is None else args.max_age * 24 * 60 * 60
+        root = os.path.join(stage_paths(args.style)["cache"], "stages")
+        deleted, freed = tk.prune_stage_cache(root, max_bytes, max_age)
+        print(f"Deleted {deleted} stored runs, freeing {freed / 1024 / 1024:.1f} MB.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+from converter import TSV2dict, TSV2table, dict2TSV, dict2columnar, iter_TSV, read_columns
+
+
+def make_scaled_copy(path, scale, output_path):
+    """
+    Write the rows of the TSV at path scale times over to output_path.
+    """
+    with open(path, "r", encoding="UTF-8") as infile:
+        header = infile.readline()
+        body = infile.read()
+    if not body.endswith("\n"):
+        body += "\n"
+    with open(output_path, "w", encoding="UTF-8") as outfile:
+        outfile.write(header)
+        for i in range(scale):
+            outfile.write(body)
+
+
+def time_call(function, *args):
+    """
+    Run function with args, hiding its printed output, and return its result
+    along with the number of seconds it took.
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def report(name, rows, seconds):
+    print(f"{name:<28}{seconds:>8.2f} s{rows / seconds:>14,.0f} rows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time converter's TSV readers and writers on a scaled-up input file.")
+    parser.add_argument("--filename", "-f", default=os.path.join("age", "input_files", "age.tsv"),
+                        help="TSV to scale up, by default age/input_files/age.tsv")
+    parser.add_argument("--scale", "-n", type=int, default=100,
+                        help="Number of copies of the file's rows to time on")
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, "scaled.tsv")
+        make_scaled_copy(args.filename, args.scale, path)
+        data_dict, seconds = time_call(TSV2dict, path)
+        rows = len(data_dict)
+        print(f"{rows:,} rows from {args.filename} x {args.scale}")
+        report("TSV2dict", rows, seconds)
+        count, seconds = time_call(lambda: sum(1 for row in iter_TSV(path)))
+        report("iter_TSV", rows, seconds)
+        table, seconds = time_call(TSV2table, path)
+        report("TSV2table", rows, seconds)
+        output = os.path.join(workdir, "output.tsv")
+        result, seconds = time_call(dict2TSV, data_dict, output)
+        report("dict2TSV from dict", rows, seconds)
+        result, seconds = time_call(dict2TSV, table, output)
+        report("dict2TSV from Table", rows, seconds)
+        columnar = os.path.join(workdir, "output.adpc")
+        result, seconds = time_call(dict2columnar, table, columnar)
+        report("dict2columnar from Table", rows, seconds)
+        table, seconds = time_call(TSV2table, columnar)
+        report("TSV2table from .adpc", rows, seconds)
+        column = next(iter(table.columns))
+        result, seconds = time_call(read_columns, columnar, [column])
+        report("read_columns, one column", rows, seconds)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,7 @@ import math
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from converter import columnar_extension, read_columns, resolve_path
 
 # Removing deprecation warning
 warnings.filterwarnings("ignore", category=Warning, module="pandas")
@@ -52,11 +53,15 @@ def round_dict_values_in_place(d, decimals=2):
             return f"Error rounding value {v} for key {k}: {e}"
     return d
 
-def load_data(file_path):
+def load_data(file_path, columns=None):
     """
     Load data from a TSV file into a pandas DataFrame.
+
+    A columnar (.adpc) file is memory-mapped instead, reading only the given columns.
     """
     try:
+        if file_path.endswith(columnar_extension):
+            return pd.DataFrame(read_columns(file_path, columns))
         return pd.read_csv(file_path, sep='\t', dtype=str, encoding='utf-8')
     except Exception as e:
         print(f"Failed to load data: {e}")
@@ -81,13 +86,30 @@ def write_results_to_tsv(results, output_file):
     results_df.to_csv(output_file, index=False, sep='\t', encoding='utf-8')
     print(f"Results written to {output_file}")
 
-def create_freq_buckets(data, col):
+def count_strings(data, col, weight_col=None):
+    """
+    Count the occurrences of each string in a column of a DataFrame.
+
+    Parameters:
+    - data (DataFrame): The input DataFrame.
+    - col (str): The name of the column to count strings in.
+    - weight_col (str): Optional column holding the number of occurrences each row stands for.
+
+    Returns:
+    - Series: The number of occurrences of each distinct string.
+    """
+    if weight_col is None:
+        return data[col].value_counts()
+    return data[weight_col].astype(int).groupby(data[col]).sum()
+
+def create_freq_buckets(data, col, weight_col=None):
     """
     Calculate frequency metrics for a given column in a DataFrame.
 
     Parameters:
     - data (DataFrame): The input DataFrame.
     - col (str): The name of the column to calculate metrics for.
+    - weight_col (str): Optional column holding the number of occurrences each row stands for.
 
     Returns:
     - dict: A dictionary containing the calculated metrics:
@@ -104,10 +126,10 @@ def create_freq_buckets(data, col):
         - high_frequency_percentage (float): The percentage of strings with frequency greater than or equal to 3 SD from the mean.
     """
     # Count the frequency of each string in the column
-    freq = data[col].value_counts()
+    freq = count_strings(data, col, weight_col)
     
     # Calculate metrics for the frequency distribution
-    total_strings = len(data)
+    total_strings = freq.sum() if weight_col is not None else len(data)
     mean = freq.mean()
     stand_dev = freq.std()
     unique = len(freq)
@@ -134,10 +156,12 @@ def create_freq_buckets(data, col):
         'high_frequency_percentage': (high_frequency.sum() / total_strings) * 100
     }
 
-def calculate_metrics(input_file, data, original_col):
+def calculate_metrics(input_file, data, original_col, weight_col=None):
     """
     Calculate various metrics including unique strings, frequency distributions,
     and percentages as specified in the manuscript.
+
+    If weight_col is given, each row counts as many strings as its value in that column.
     """
     # Define the phrase-normalized column name
     phrase_normalized_col = f'phrase_normalized_{original_col}'
@@ -151,7 +175,7 @@ def calculate_metrics(input_file, data, original_col):
         norm_loc_col = f'phrase_normalized_{original_col}'
         
         # Find the strings that appear only once in the norm_loc_col column...
-        is_unique_in_loc_norm_strings = data[norm_loc_col].map(data[norm_loc_col].value_counts()) == 1
+        is_unique_in_loc_norm_strings = data[norm_loc_col].map(count_strings(data, norm_loc_col, weight_col)) == 1
         # ...'fail' for normalized...
         is_N_in_norm = data['phrase_validation'] == 'fail'
         # ...is not numeric...
@@ -160,7 +184,7 @@ def calculate_metrics(input_file, data, original_col):
         unique_N_str = data[is_unique_in_loc_norm_strings & is_N_in_norm & not_numeric]
 
         # Save the unique strings for manual review        
-        manual_review_file = input_file.replace('.tsv', '_manual_review.tsv')
+        manual_review_file = input_file.replace(columnar_extension, '.tsv').replace('.tsv', '_manual_review.tsv')
         print(f"Saving strings for manual review to {manual_review_file}")
         unique_N_str[norm_loc_col].to_csv(manual_review_file, index=False, sep='\t', encoding='utf-8')
 
@@ -168,8 +192,8 @@ def calculate_metrics(input_file, data, original_col):
     data = data.fillna('null')
 
     # Create metrics dictionaries for original and phrase-normalized columns
-    metrics_original = create_freq_buckets(data, original_col)
-    metrics_phrase_normalized = create_freq_buckets(data, phrase_normalized_col)
+    metrics_original = create_freq_buckets(data, original_col, weight_col)
+    metrics_phrase_normalized = create_freq_buckets(data, phrase_normalized_col, weight_col)
     
     # Format results before filling in dictionary following manuscript metrics
     # Unique Strings
@@ -177,7 +201,7 @@ def calculate_metrics(input_file, data, original_col):
     if metrics_original['unique_strings'] > metrics_phrase_normalized['unique_strings']:
         unique_strings_change *= -1
     # Ratios of unique strings before and after phrase normalization
-    total_strings = len(data)
+    total_strings = metrics_original['total_strings']
     ratio_value_unique_original = total_strings / metrics_original['unique_strings']
     ratio_value_unique_phrase_normalized = total_strings / metrics_phrase_normalized['unique_strings']
     unique_ratio_change = (abs(ratio_value_unique_original - ratio_value_unique_phrase_normalized) / ratio_value_unique_original) * 100
@@ -509,7 +533,16 @@ def generate_additional_figures(input_file, style):
     '''
     Generates additional figures based on the dataset style.
     '''
-    data = pd.read_csv(input_file, sep='\t')
+    if input_file.endswith(columnar_extension):
+        columns = ['char_validation', 'word_validation', 'phrase_validation']
+        numeric_columns = ['char_distance_score', 'word_distance_score']
+        if style == 'data_loc':
+            numeric_columns += ['split_phrase_count', 'phrase_validity_rate']
+        data = load_data(input_file, columns + numeric_columns)
+        for column in numeric_columns:
+            data[column] = pd.to_numeric(data[column])
+    else:
+        data = pd.read_csv(input_file, sep='\t')
 
     # Generate scatter plots for data location datasets "split_phrase_count" vs. "phrase_validity_rate"
     if style == 'data_loc':
@@ -527,16 +560,20 @@ def main():
     Main function to load data, calculate metrics, and write results to TSV files.
     """
     if len(sys.argv) < 5:
-        print("Usage: python calculate_metrics.py <tsv_file_path> <original_column_name> <output_directory_path> <style>")
+        print("Usage: python calculate_metrics.py <tsv_file_path> <original_column_name> <output_directory_path> <style> [weight_column_name]")
         sys.exit(1)
 
     style = sys.argv[4]
-    input_file = os.path.join(style, sys.argv[1])
+    input_file = resolve_path(os.path.join(style, sys.argv[1]))
     original_col = sys.argv[2]
     output_dir = os.path.join(style, sys.argv[3])
+    weight_col = sys.argv[5] if len(sys.argv) > 5 else None
 
-    data = load_data(input_file)
-    final_results = calculate_metrics(input_file, data, original_col)
+    columns = [original_col, f'phrase_normalized_{original_col}', 'phrase_validation']
+    if weight_col:
+        columns.append(weight_col)
+    data = load_data(input_file, columns)
+    final_results = calculate_metrics(input_file, data, original_col, weight_col)
     
     # Write final reporting result
     output_file = os.path.join(output_dir, f'{original_col}_final_results.tsv')
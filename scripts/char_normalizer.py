@@ -1,13 +1,100 @@
+import argparse
 import os
 import re
 import sys
 import toolkit as tk
-from converter import TSV2dict, dict2TSV
+from converter import TSV2table, data_path, dict2TSV
 
 
 approved_chars = r"[a-z\d ,.+/<>()-:]"
 
 
+class TranslationEngine:
+    """
+    Character-stage rules precomputed for str methods implemented in C.
+
+    Holds the replace/remove rows of a char reference dict as str.translate
+    tables, so fixing the invalid characters of a string takes one pass over
+    it. Each table holds only the rules for one set of items, as
+    tk.handle_invalid_items passes them, and is built the first time that
+    set is seen. Can be passed to tk.handle_invalid_items in place of a
+    tk.RuleProgram.
+
+    One pass only gives the sequential result if no replacement contains a
+    character with a rule of its own, or a backslash, which re.sub expands.
+    Strings with a character whose replacement does are handled by a
+    tk.RuleProgram instead. Which characters are approved is worked out the
+    first time each is seen.
+    """
+
+    def __init__(self, reference_dict):
+        self.approved = set()
+        self.unapproved = set()
+        replacements = {}
+        for index, rowdict in reference_dict.items():
+            char = rowdict["unknown_character"]
+            if char in replacements or len(char) != 1 or self.is_approved(char):
+                continue
+            if rowdict["replace_with"] != "":
+                replacements[char] = rowdict["replace_with"]
+            elif rowdict["remove"] != "":
+                replacements[char] = ""
+            else:
+                replacements[char] = None
+        replacements = {char: replacement for char, replacement in replacements.items()
+                        if replacement is not None}
+        self.replacements = replacements
+        self.tables = {}
+        self.chained = set(char for char, replacement in replacements.items()
+                           if "\\" in replacement
+                           or not replacements.keys().isdisjoint(replacement))
+        self.program = None
+        if len(self.chained) != 0:
+            self.program = tk.RuleProgram(reference_dict, "char", None)
+
+    def is_approved(self, char):
+        """
+        Tell whether char matches approved_chars.
+        """
+        if char in self.approved:
+            return True
+        if char in self.unapproved:
+            return False
+        if re.fullmatch(approved_chars, char):
+            self.approved.add(char)
+            return True
+        self.unapproved.add(char)
+        return False
+
+    def identify_invalid_chars(self, string):
+        """
+        Return a set of invalid characters found in input string.
+        """
+        chars = set(string)
+        for char in chars.difference(self.approved, self.unapproved):
+            self.is_approved(char)
+        return chars.difference(self.approved)
+
+    def apply(self, items, data_item):
+        """
+        Apply the actions for items, all found in the reference dict, to data_item.
+        """
+        if self.program is not None and not self.chained.isdisjoint(items):
+            return self.program.apply(items, data_item)
+        key = frozenset(items)
+        table = self.tables.get(key)
+        if table is None:
+            table = str.maketrans({char: self.replacements[char] for char in key
+                                   if char in self.replacements})
+            self.tables[key] = table
+        data_item = data_item.translate(table)
+        # normalize_whitespace isn't idempotent, e.g., "a ." -> "a " -> "a", so it
+        # runs once per item, as when each item's action is applied in turn
+        for _ in items:
+            data_item = tk.normalize_whitespace(data_item)
+        return data_item
+
+
 def identify_invalid_chars(string):
     """
     Return a set of invalid characters found in input string.
@@ -20,96 +107,238 @@ def identify_invalid_chars(string):
     return invalid_chars
 
 
-def track_changes(original_string, new_string, change_dict, tracker_item):
+def normalize_chars(style, data_file, target_column, review_file, reference_file,
+                    engine="regex", dedup=False, weight_column=None, compress=None,
+                    columnar=False, cache_dir=None, stage_cache_dir=None, memo_path=None):
     """
-    Logs whether a string was changed at a particular normalization step.
+    Performs character normalization on target_column in data_file.
+
+    Reads or creates reference & review dicts, normalizes the data with
+    normalize_char_data, and writes the output, review and reference files.
+    If compress is "gz", "xz" or "zst", the output file is compressed with it;
+    if columnar is True, it is written in the binary columnar format instead.
+    See iter_normalize_chars for cache_dir and memo_path.
+
+    If stage_cache_dir is given, the output, review and reference files are
+    kept in a tk.StageCache there, and restored from it instead of normalizing
+    when the data file, sheets and settings match an earlier run.
     """
-    if original_string != new_string:
-        change_dict[tracker_item] = "Y"
-    else:
-        change_dict[tracker_item] = "N"
+    output_path = data_path(os.path.join(style, "output_files", f"c_norm_{style}.tsv"),
+                            compress, columnar)
+    outputs = [output_path, review_file, reference_file]
+    if stage_cache_dir is not None:
+        stage_cache = tk.StageCache(stage_cache_dir)
+        key = stage_cache.key("char", [data_file, review_file, reference_file], outputs,
+                              (target_column, engine, dedup, weight_column),
+                              [sys.modules[__name__]])
+        if stage_cache.restore(key, outputs):
+            return
+    data_dict = TSV2table(data_file)
+    review_dict, reference_dict = tk.load_sheets(review_file, reference_file)
+    data_dict, review_dict, reference_dict = normalize_char_data(style,
+                                                                 data_dict,
+                                                                 target_column,
+                                                                 review_dict,
+                                                                 reference_dict,
+                                                                 engine,
+                                                                 dedup,
+                                                                 weight_column,
+                                                                 cache_dir=cache_dir,
+                                                                 memo_path=memo_path)
+    dict2TSV(data_dict, output_path)
+    tk.write_sheets(review_dict, review_file, reference_dict, reference_file)
+    if stage_cache_dir is not None:
+        stage_cache.store(key, outputs)
 
 
-def track_basic_normalization(data_item, index):
+def normalize_char_data(style, data_dict, target_column, review_dict, reference_dict,
+                        engine="regex", dedup=False, weight_column=None, workers=1,
+                        cache_dir=None, memo_path=None):
     """
-    Applies basic char normalization to a string and returns change tracker.
+    Performs character normalization on target_column in data_dict.
+
+    See iter_normalize_chars for the arguments.
+    Returns data_dict, review_dict and reference_dict.
     """
-    item_change_dict = {}
-    item_change_dict["index"] = index
-    item_change_dict["before_char_normalization"] = data_item
-    data_stripped = tk.normalize_whitespace(data_item)
-    track_changes(data_item, data_stripped, item_change_dict, "whitespace")
-    item_change_dict["after_char_normalization"] = data_stripped
-    return data_stripped, item_change_dict
+    rows = iter_normalize_chars(style,
+                                data_dict.items(),
+                                target_column,
+                                review_dict,
+                                reference_dict,
+                                engine,
+                                dedup,
+                                weight_column,
+                                workers,
+                                cache_dir,
+                                memo_path)
+    for index, rowdict in rows:
+        data_dict[index] = rowdict
+    return data_dict, review_dict, reference_dict
 
 
-def normalize_chars(style, data_file, target_column, review_file, reference_file):
+class CharStage(tk.RuleStage):
     """
-    Performs character normalization on target_column in data_file.
+    Character normalization rules compiled for normalizing one row at a time.
 
-    Reads or creates reference & review dicts, performs basic normalization on
-    data items, attempts to replace or remove invalid characters in those data
-    items if possible, and if no replacement has been specified, adds them to
-    review file for manual review.
+    Takes review_dict and reference_dict as loaded from the sheets, moves
+    actioned review rows to reference_dict and compiles the reference rules.
+    process normalizes a row and logs its unknown characters to review_dict.
+    If cache_dir is given, results are kept there in a tk.ResultCache, and if
+    memo_path is given, in a tk.MemoStore in that file.
     """
-    data_dict = TSV2dict(data_file)
-    output_column = f"char_normalized_{target_column}"
-    char_change_dict = {}
-    allowed_chars = set()
-    if os.path.isfile(review_file):
-        review_dict = TSV2dict(review_file)
-    else:
-        review_dict = {}
-    if os.path.isfile(reference_file):
-        reference_dict = TSV2dict(reference_file)
-    else:
-        reference_dict = {}
-    review_dict, reference_dict, allowed_chars = tk.update_reference(review_dict, reference_dict, allowed_chars)
-    review_dict = tk.clean_occurrences(review_dict)
-    for index, rowdict in data_dict.items():
-        data_item = rowdict[target_column]
-        data_item, changes = track_basic_normalization(data_item, index)
-        char_change_dict[index] = changes
-        invalid_chars = identify_invalid_chars(data_item)
+
+    def __init__(self, style, target_column, review_dict, reference_dict, engine="regex",
+                 dedup=False, weight_column=None, cache_dir=None, memo_path=None):
+        super().__init__("char", style, dedup, weight_column)
+        self.target_column = target_column
+        self.output_column = f"char_normalized_{target_column}"
+        self.allowed_chars = set()
+        self.rule_index = tk.RuleIndex(review_dict, reference_dict, "char")
+        review_dict, reference_dict, self.allowed_chars = tk.update_reference(review_dict,
+                                                                              reference_dict,
+                                                                              self.allowed_chars,
+                                                                              self.rule_index)
+        self.review_dict = tk.clean_occurrences(review_dict)
+        self.reference_dict = reference_dict
+        if engine == "translate":
+            self.program = TranslationEngine(reference_dict)
+            self.identify = self.program.identify_invalid_chars
+        else:
+            self.program = tk.RuleProgram(reference_dict, "char", None)
+            self.identify = identify_invalid_chars
+        self.result_columns = ["char_validation", self.output_column, "char_distance_score"]
+        if cache_dir is not None or memo_path is not None:
+            settings = ("char", style, target_column, engine,
+                        tk.source_digest(sys.modules[__name__], tk))
+            rules = tk.rule_summaries(self.reference_dict, self.rule_index, self.allowed_chars)
+            self.open_results(target_column, settings, rules, cache_dir, memo_path)
+
+    def process(self, index, rowdict):
+        """
+        Normalize target_column of rowdict and log its unknown characters.
+
+        Returns rowdict and the review events it logged.
+        """
+        data_item = rowdict[self.target_column]
+        weight = self.weight(rowdict)
+        recalled = self.recall(data_item)
+        if recalled is not None:
+            results, review_log = recalled
+            rowdict.update(results)
+            self.replay(review_log, weight)
+            return rowdict, review_log
+        review_log = []
+        data_item = tk.normalize_whitespace(data_item)
+        invalid_chars = self.identify(data_item)
+        items = set(invalid_chars)
         rowdict["char_validation"] = tk.validate(invalid_chars, "string")
         if tk.validate(invalid_chars, "boolean"):
-            rowdict[output_column] = data_item
+            rowdict[self.output_column] = data_item
         else:
-            review_dict, reference_dict, data_item, allowed_chars = tk.handle_invalid_items(
-                style,
-                invalid_chars,
-                review_dict,
-                reference_dict,
-                "char",
-                data_item,
-                allowed_chars,
-                None
-            )
-            invalid_chars = identify_invalid_chars(data_item)
+            self.review_dict, self.reference_dict, data_item, self.allowed_chars = \
+                tk.handle_invalid_items(
+                    self.style,
+                    invalid_chars,
+                    self.review_dict,
+                    self.reference_dict,
+                    "char",
+                    data_item,
+                    self.allowed_chars,
+                    None,
+                    self.rule_index,
+                    self.program,
+                    review_log,
+                    weight
+                )
+            invalid_chars = self.identify(data_item)
+            items.update(invalid_chars)
             for char in invalid_chars.copy():
-                if char in allowed_chars:
+                if char in self.allowed_chars:
                     invalid_chars.remove(char)
             rowdict["char_validation"] = tk.validate(invalid_chars, "string")
             if tk.validate(invalid_chars, "boolean"):
-                rowdict[output_column] = data_item
+                rowdict[self.output_column] = data_item
             else:
-                rowdict[output_column] = f"! Invalid characters: {sorted(invalid_chars)} !"
+                rowdict[self.output_column] = f"! Invalid characters: {sorted(invalid_chars)} !"
         rowdict = tk.evaluate_ld(rowdict,
                                  "char",
-                                 target_column,
-                                 output_column)
-    output_path = os.path.join(style, "output_files", f"c_norm_{style}.tsv")
-    dict2TSV(data_dict, output_path)
-    if len(review_dict.keys()) != 0:
-        dict2TSV(review_dict, review_file)
-    if len(reference_dict.keys()) != 0:
-        dict2TSV(reference_dict, reference_file)
+                                 self.target_column,
+                                 self.output_column)
+        self.remember(rowdict[self.target_column], rowdict, review_log, items)
+        return rowdict, review_log
 
 
-if __name__ == "__main__":
-    style = sys.argv[1]
-    input_file = os.path.join(style, "input_files", sys.argv[2])
-    target_column = sys.argv[3]
+def iter_normalize_chars(style, rows, target_column, review_dict, reference_dict,
+                         engine="regex", dedup=False, weight_column=None, workers=1,
+                         cache_dir=None, memo_path=None):
+    """
+    Performs character normalization on target_column in a stream of rows.
+
+    Performs basic normalization on data items, attempts to replace or remove
+    invalid characters in those data items if possible, and if no replacement
+    has been specified, adds them to review_dict for manual review.
+
+    rows is an iterable of (index, rowdict) pairs, each of which is yielded as
+    soon as its row is normalized. review_dict and reference_dict are updated
+    in place.
+
+    engine selects how rules are applied: "regex" matches characters with
+    approved_chars and a compiled tk.RuleProgram, "translate" uses a
+    TranslationEngine. Both give the same output.
+
+    If dedup is True, each distinct data item is normalized once and its result
+    is reused for repeats, which are still counted in the review file.
+
+    If weight_column is given, each row counts as that column's value of
+    occurrences in the review file, e.g., for a table of distinct values and
+    their counts.
+
+    If workers is more than 1, rows are normalized in that many processes and
+    their review events are logged here in row order, so review_dict ends up
+    the same as in a single-process run.
+
+    If cache_dir is given, each distinct data item's results are kept in a
+    file there, and the next run normalizes again only the data items with
+    characters whose reference rules have changed, reusing the rest. This
+    needs a single process.
+
+    If memo_path is given, results are also looked up in and added to an
+    SQLite database there, keyed by style, data item and a hash of all the
+    rules, so data items normalized by any earlier run with the same rules
+    are not normalized again. This also needs a single process.
+    """
+    if workers > 1 and (cache_dir is not None or memo_path is not None):
+        raise ValueError("Results can only be cached when normalizing in one process.")
+    stage = CharStage(style, target_column, review_dict, reference_dict, engine, dedup,
+                      weight_column, cache_dir, memo_path)
+    worker_args = (style, target_column, {}, stage.reference_dict, engine, dedup, weight_column)
+    yield from tk.iter_stage_rows(stage, rows, workers, worker_args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("style",
+                        help="Data style, e.g., age or data_loc")
+    parser.add_argument("filename",
+                        help="Name of the TSV in <style>/input_files, e.g., age.tsv")
+    parser.add_argument("column",
+                        help="Name of the column to normalize, e.g., h_age")
+    parser.add_argument("--engine", "-e", choices=["regex", "translate"], default="regex",
+                        help="How character rules are applied")
+    parser.add_argument("--weights", "-w",
+                        help="Column holding the number of occurrences each row stands for")
+    tk.add_stage_arguments(parser)
+    args = parser.parse_args()
+    style = args.style
+    input_file = os.path.join(style, "input_files", args.filename)
     review = os.path.join(style, "output_files", "char_review.tsv")
     reference = os.path.join(style, "output_files", "char_reference.tsv")
-    normalize_chars(style, input_file, target_column, review, reference)
+    cache_dir = os.path.join(style, "output_files", "cache")
+    normalize_chars(style, input_file, args.column, review, reference,
+                    args.engine, args.dedup, args.weights, args.compress, args.columnar,
+                    cache_dir if args.incremental else None,
+                    None if args.no_cache else cache_dir, args.memo)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import contextlib
+import filecmp
+import io
+import os
+import shutil
+import sys
+import tempfile
+import char_normalizer as cn
+import toolkit as tk
+from converter import TSV2table, dict2TSV
+
+
+def run_engine(style, data_file, column, engine, workdir):
+    """
+    Normalize column of data_file with engine, starting from the style's char
+    review and reference files, and write the output and sheets to workdir.
+    Returns the paths written, by name.
+    """
+    output_dir = os.path.join(style, "output_files")
+    with contextlib.redirect_stdout(io.StringIO()):
+        review_dict, reference_dict = tk.load_sheets(os.path.join(output_dir, "char_review.tsv"),
+                                                     os.path.join(output_dir,
+                                                                  "char_reference.tsv"))
+        data_dict = TSV2table(data_file)
+        data_dict, review_dict, reference_dict = cn.normalize_char_data(style,
+                                                                        data_dict,
+                                                                        column,
+                                                                        review_dict,
+                                                                        reference_dict,
+                                                                        engine)
+        paths = {name: os.path.join(workdir, f"{engine}_{name}.tsv")
+                 for name in ["c_norm", "char_review", "char_reference"]}
+        dict2TSV(data_dict, paths["c_norm"])
+        tk.write_sheets(review_dict, paths["char_review"], reference_dict,
+                        paths["char_reference"])
+    return paths
+
+
+def same_file(path, other_path):
+    """
+    Tell whether two files have the same contents, or both don't exist.
+    """
+    if not os.path.isfile(path) or not os.path.isfile(other_path):
+        return os.path.isfile(path) == os.path.isfile(other_path)
+    return filecmp.cmp(path, other_path, shallow=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the regex and translate engines give the same char output.")
+    parser.add_argument("style",
+                        help="Data style, e.g., age or data_loc")
+    parser.add_argument("filename",
+                        help="Name of the TSV in <style>/input_files, e.g., age.tsv")
+    parser.add_argument("column",
+                        help="Name of the column to normalize, e.g., h_age")
+    args = parser.parse_args()
+    data_file = os.path.join(args.style, "input_files", args.filename)
+    workdir = tempfile.mkdtemp()
+    try:
+        regex_paths = run_engine(args.style, data_file, args.column, "regex", workdir)
+        translate_paths = run_engine(args.style, data_file, args.column, "translate", workdir)
+        differing = []
+        for name in regex_paths:
+            same = same_file(regex_paths[name], translate_paths[name])
+            print(f"{name:<16}{'same' if same else 'differs'}")
+            if not same:
+                differing.append(name)
+    finally:
+        shutil.rmtree(workdir)
+    if differing:
+        sys.exit(f"The engines give different {', '.join(differing)} files.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,725 @@
 import csv
+import gc
+import gzip
+import io
+import itertools
+import json
+import lzma
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import MutableMapping
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
+# Size of the read and write buffers used for whole-file reads and writes
+buffer_size = 1 << 20
 
-def TSV2dict(path):
+compressed_extensions = [".gz", ".xz", ".zst"]
+
+# Extension and leading/trailing marker of the binary columnar format
+columnar_extension = ".adpc"
+columnar_magic = b"ADPCOL01"
+
+# Extension and leading marker of the line-offset index kept next to a TSV
+index_extension = ".idx"
+index_magic = b"ADPIDX01"
+
+
+def open_file(path, mode="r", newline=None):
+    """
+    Opens a text file for reading ("r") or writing ("w"), streaming it through
+    gzip, xz or zstandard if path ends with .gz, .xz or .zst.
+
+    -- path: Path of file to be opened.
+    -- mode: "r" or "w".
+    -- newline: As for open().
+    -- Returns the open file.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, f"{mode}t", compresslevel=6, encoding="utf-8", newline=newline)
+    if path.endswith(".xz"):
+        return lzma.open(path, f"{mode}t", encoding="utf-8", newline=newline)
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(f"Reading or writing {path} requires the zstandard package.")
+        return zstandard.open(path, f"{mode}t", encoding="utf-8", newline=newline)
+    return open(path, mode, encoding="utf-8", newline=newline, buffering=buffer_size)
+
+
+def default_delimiter(path):
+    """
+    Returns "," for .csv files, compressed or not, and a tab otherwise.
+    """
+    for extension in compressed_extensions:
+        if path.endswith(extension):
+            path = path[:-len(extension)]
+    return "," if path.endswith(".csv") else "\t"
+
+
+def data_path(path, compress=None, columnar=False):
+    """
+    Returns the path a data file meant for path (a .tsv) is written to: its
+    .adpc version if columnar is True, otherwise path with .gz, .xz or .zst
+    added if compress is "gz", "xz" or "zst".
+    """
+    if columnar:
+        return os.path.splitext(path)[0] + columnar_extension
+    if compress:
+        return f"{path}.{compress}"
+    return path
+
+
+def resolve_path(path):
+    """
+    Finds the file a reader should use for path: whichever of path, its .gz,
+    .xz and .zst versions and its .adpc version exists and was modified last,
+    or path itself if none exist.
+    """
+    candidates = [path] + [f"{path}{extension}" for extension in compressed_extensions]
+    if path.endswith(".tsv"):
+        candidates.append(data_path(path, columnar=True))
+    existing = [candidate for candidate in candidates if os.path.isfile(candidate)]
+    if not existing:
+        return path
+    return max(existing, key=os.path.getmtime)
+
+
+class MissingCell:
+    """
+    Marks a cell of a Table whose row doesn't have that column. Unlike None,
+    which csv.DictReader gives the cells a short row lacks, it isn't a value.
+    """
+
+    def __repr__(self):
+        return "missing_cell"
+
+    def __reduce__(self):
+        return "missing_cell"
+
+
+missing_cell = MissingCell()
+
+
+class RowView(MutableMapping):
+    """
+    One row of a Table, read and written in place through the table's columns.
+
+    Missing cells (missing_cell in a column) are treated as absent keys.
+    Pickles as a plain dict, e.g., when rows are sent to worker processes.
+    """
+
+    __slots__ = ("table", "position")
+
+    def __init__(self, table, position):
+        self.table = table
+        self.position = position
+
+    def __getitem__(self, key):
+        column = self.table.columns.get(key)
+        if column is None or column[self.position] is missing_cell:
+            raise KeyError(key)
+        return column[self.position]
+
+    def __setitem__(self, key, value):
+        self.table.set(self.position, key, value)
+
+    def __delitem__(self, key):
+        self[key]
+        self.table.columns[key][self.position] = missing_cell
+
+    def __contains__(self, key):
+        column = self.table.columns.get(key)
+        return column is not None and column[self.position] is not missing_cell
+
+    def __iter__(self):
+        for key, column in self.table.columns.items():
+            if column[self.position] is not missing_cell:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __reduce__(self):
+        return dict, (list(self.items()),)
+
+
+class Table(MutableMapping):
+    """
+    Rows of a TSV stored as one list per column instead of one dict per row.
+
+    Works like the dict of dicts made by TSV2dict: keys are row indices and
+    values are RowViews that read and write the columns in place. Repeated
+    string values are interned so each distinct value is stored once.
+    column(name) gives a column's list itself without copying it.
+    """
+
+    def __init__(self, fieldnames=()):
+        self.columns = {name: [] for name in fieldnames}
+        self.indices = []
+        self.positions = {}
+
+    def column(self, name):
+        """
+        Return the list of values in column name, with missing_cell for
+        missing cells.
+        """
+        return self.columns[name]
+
+    def set(self, position, key, value):
+        """
+        Set the value of column key in the row at position.
+        """
+        if key not in self.columns:
+            self.columns[key] = [missing_cell] * len(self.indices)
+        if type(value) is str:
+            value = sys.intern(value)
+        self.columns[key][position] = value
+
+    def append(self, index, values):
+        """
+        Add a row from a list of values in the order of the table's columns.
+        A row with an index already in the table replaces that row's values.
+        """
+        if index in self.positions:
+            position = self.positions[index]
+            for key, value in zip(list(self.columns), values):
+                self.set(position, key, value)
+            return
+        self.positions[index] = len(self.indices)
+        self.indices.append(index)
+        for column, value in zip(self.columns.values(), values):
+            column.append(sys.intern(value) if type(value) is str else value)
+
+    def extend(self, indices, columns):
+        """
+        Add a block of rows from one list of values per column, in the order of
+        the table's columns.
+        """
+        if len(set(indices)) != len(indices) or not self.positions.keys().isdisjoint(indices):
+            for index, values in zip(indices, zip(*columns)):
+                self.append(index, values)
+            return
+        start = len(self.indices)
+        self.positions.update(zip(indices, range(start, start + len(indices))))
+        self.indices.extend(indices)
+        for column, values in zip(self.columns.values(), columns):
+            try:
+                column.extend(map(sys.intern, values))
+            except TypeError:
+                # Not all strings, e.g., an index column or padded short rows
+                del column[start:]
+                column.extend([sys.intern(value) if type(value) is str else value
+                               for value in values])
+
+    def copy(self):
+        """
+        Return a new Table with the same rows, sharing no lists with this one.
+        """
+        table = Table()
+        table.columns = {name: list(column) for name, column in self.columns.items()}
+        table.indices = list(self.indices)
+        table.positions = dict(self.positions)
+        return table
+
+    def __getitem__(self, index):
+        return RowView(self, self.positions[index])
+
+    def __setitem__(self, index, row):
+        if index in self.positions:
+            position = self.positions[index]
+            if type(row) is RowView and row.table is self and row.position == position:
+                return
+        else:
+            self.append(index, [missing_cell] * len(self.columns))
+            position = self.positions[index]
+        row = dict(row)
+        for key, column in self.columns.items():
+            if key not in row:
+                column[position] = missing_cell
+        for key, value in row.items():
+            self.set(position, key, value)
+
+    def __delitem__(self, index):
+        position = self.positions.pop(index)
+        del self.indices[position]
+        for column in self.columns.values():
+            del column[position]
+        for i in range(position, len(self.indices)):
+            self.positions[self.indices[i]] = i
+
+    def __contains__(self, index):
+        return index in self.positions
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __repr__(self):
+        return f"<Table of {len(self)} rows: {', '.join(self.columns)}>"
+
+
+class ColumnarFile:
+    """
+    A memory-mapped file written by dict2columnar.
+
+    Each column is stored as its distinct values followed by one code per row
+    pointing at a value, so column(name) decodes only that column and reads
+    nothing else from disk. Cells are stored as the text a TSV would hold, so
+    the rows read back as they would from the TSV.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as infile:
+            self.map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self.map)
+        if size < 32 or self.map[:8] != columnar_magic or self.map[-8:] != columnar_magic:
+            self.map.close()
+            raise ValueError(f"{path} is not a columnar data file.")
+        footer_length, = struct.unpack("<Q", self.map[-16:-8])
+        footer = json.loads(self.map[size - 16 - footer_length:size - 16].decode("utf-8"))
+        self.path = path
+        self.rows = footer["rows"]
+        self.byteorder = footer["byteorder"]
+        self.layout = {entry["name"]: entry for entry in footer["columns"]}
+        self.fieldnames = [entry["name"] for entry in footer["columns"]]
+
+    def read_array(self, typecode, start, count):
+        """
+        Return count numbers of array typecode stored from byte start.
+        """
+        numbers = array(typecode)
+        numbers.frombytes(self.map[start:start + count * numbers.itemsize])
+        if self.byteorder != sys.byteorder:
+            numbers.byteswap()
+        return numbers
+
+    def values(self, name):
+        """
+        Return the distinct values of column name, in the order of their codes.
+        """
+        entry = self.layout[name]
+        offsets = self.read_array("Q", entry["offsets"], entry["distinct"] + 1)
+        data = self.map[entry["values"]:entry["values"] + offsets[-1]]
+        if data.isascii():
+            # Byte offsets are character offsets, so decode the values at once
+            data = data.decode("ascii")
+            return [data[start:end] for start, end in zip(offsets, offsets[1:])]
+        return [data[start:end].decode("utf-8") for start, end in zip(offsets, offsets[1:])]
+
+    def codes(self, name):
+        """
+        Return the array of each row's code into the values of column name.
+        """
+        return self.read_array("I", self.layout[name]["codes"], self.rows)
+
+    def column(self, name):
+        """
+        Return the list of values in column name.
+        """
+        return list(map(self.values(name).__getitem__, self.codes(name)))
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_columns(path, columns=None):
+    """
+    Reads the named columns, or all columns, of a columnar data file.
+
+    -- path: Path of a file written by dict2columnar.
+    -- columns: Names of the columns to read; defaults to all of them.
+    -- Returns a dict of column name to list of values.
+    """
+    with ColumnarFile(path) as columnar:
+        if columns is None:
+            columns = columnar.fieldnames
+        return {name: columnar.column(name) for name in columns}
+
+
+def dict2columnar(xdict, path):
+    """
+    Writes a dict in the format created by TSV2dict, or a Table, to the binary
+    columnar format read by ColumnarFile. The columns are those of the first
+    row, as with dict2TSV, and missing cells are stored as empty strings.
+
+    -- xdict: Name of the dict to be written.
+    -- path: Path of output file, usually ending in .adpc.
+    """
+    fieldnames = list(xdict[next(iter(xdict))].keys())
+    if type(xdict) is Table:
+        columns = [xdict.columns[name] for name in fieldnames]
+    else:
+        columns = [[row.get(name) for row in xdict.values()] for name in fieldnames]
+    entries = []
+    with open(path, "wb") as outfile:
+        outfile.write(columnar_magic)
+        for name, column in zip(fieldnames, columns):
+            codes = {}
+            row_codes = array("I", [codes.setdefault("" if value is None or value is missing_cell
+                                                     else str(value), len(codes))
+                                    for value in column])
+            encoded = [value.encode("utf-8") for value in codes]
+            offsets = array("Q", [0])
+            offsets.extend(itertools.accumulate(map(len, encoded)))
+            entry = {"name": name, "distinct": len(encoded), "offsets": outfile.tell()}
+            outfile.write(offsets.tobytes())
+            entry["values"] = outfile.tell()
+            outfile.write(b"".join(encoded))
+            # Keep the codes aligned to their item size
+            outfile.write(bytes(-outfile.tell() % 8))
+            entry["codes"] = outfile.tell()
+            outfile.write(row_codes.tobytes())
+            outfile.write(bytes(-outfile.tell() % 8))
+            entries.append(entry)
+        footer = json.dumps({"rows": len(xdict), "byteorder": sys.byteorder,
+                             "columns": entries}).encode("utf-8")
+        outfile.write(footer)
+        outfile.write(struct.pack("<Q", len(footer)))
+        outfile.write(columnar_magic)
+    print(f"{path} written and saved.")
+
+
+def build_line_index(path, delimiter=None):
+    """
+    Finds the byte offset at which each row of a TSV starts, skipping the
+    header and blank lines. Rows whose quoted fields span several lines are
+    kept whole, as csv reads them.
+
+    -- path: Path of an uncompressed TSV.
+    -- delimiter: Field delimiter; defaults to "," for .csv files, tab otherwise.
+    -- Returns an array of offsets, one per row.
+    """
+    offsets = array("Q")
+    end = [0]
+
+    def iter_lines(infile):
+        for line in infile:
+            end[0] += len(line)
+            yield line.decode("utf-8")
+
+    with open(path, "rb", buffering=buffer_size) as infile:
+        reader = csv.reader(iter_lines(infile), delimiter=delimiter or default_delimiter(path))
+        next(reader, None)
+        start = end[0]
+        for row in reader:
+            if row:
+                offsets.append(start)
+            start = end[0]
+    offsets.append(end[0])
+    return offsets
+
+
+def load_line_index(path, delimiter=None):
+    """
+    Returns the row offsets of a TSV from the index file kept next to it,
+    building and saving the index first if it is missing or older than the TSV.
+
+    -- path: Path of an uncompressed TSV; its index is path + ".idx".
+    -- delimiter: As for build_line_index.
+    -- Returns an array of row start offsets, followed by the end of the file.
+    """
+    index_path = path + index_extension
+    stat = os.stat(path)
+    stamp = struct.pack("<QQ", stat.st_size, stat.st_mtime_ns)
+    if os.path.isfile(index_path):
+        with open(index_path, "rb") as infile:
+            header = infile.read(len(index_magic) + len(stamp))
+            if header == index_magic + stamp:
+                offsets = array("Q")
+                offsets.frombytes(infile.read())
+                if sys.byteorder != "little":
+                    offsets.byteswap()
+                return offsets
+    offsets = build_line_index(path, delimiter)
+    stored = array("Q", offsets)
+    if sys.byteorder != "little":
+        stored.byteswap()
+    temporary_path = f"{index_path}.{os.getpid()}"
+    with open(temporary_path, "wb") as outfile:
+        outfile.write(index_magic + stamp)
+        outfile.write(stored.tobytes())
+    os.replace(temporary_path, index_path)
+    return offsets
+
+
+class LazyTSV:
+    """
+    A memory-mapped TSV whose rows are read one at a time by position.
+
+    Uses the line-offset index from load_line_index, so fetching a row reads
+    only that row from disk. row(position) gives the same (index, row dict)
+    pair that iter_TSV yields for that row.
+    """
+
+    def __init__(self, path, delimiter=None):
+        self.path = path
+        self.delimiter = delimiter or default_delimiter(path)
+        self.offsets = load_line_index(path, self.delimiter)
+        with open(path, "rb") as infile:
+            header = infile.readline().decode("utf-8")
+            # Empty files can't be memory-mapped, and have no rows to read
+            self.map = None
+            if os.path.getsize(path):
+                self.map = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        self.fieldnames = next(csv.reader([header], delimiter=self.delimiter), [])
+
+    def row(self, position):
+        """
+        Return the (index, row dict) pair of the row at position, counting from 0.
+        """
+        if not 0 <= position < len(self):
+            raise IndexError(f"{self.path} has no row {position}.")
+        text = self.map[self.offsets[position]:self.offsets[position + 1]].decode("utf-8")
+        reader = csv.DictReader(io.StringIO(text, newline=""), fieldnames=self.fieldnames,
+                                delimiter=self.delimiter)
+        row = next(reader)
+        if "index" not in row:
+            row["index"] = position
+            return position, row
+        return int(row["index"]), row
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_blocks(path, delimiter=None, block_rows=65536):
+    """
+    Reads a TSV in large blocks, yielding (fieldnames, columns) for each block
+    of up to block_rows rows, where columns holds one list of values per field.
+    Yields one empty block if the file has no rows.
+
+    As with csv.DictReader, the cells a short row lacks are None, and the
+    extra cells of a long row are listed in a field named None; rows without
+    extra cells have missing_cell in that field.
+
+    -- path: Path of TSV to be read; .gz, .xz and .zst files are decompressed,
+       and .adpc files are read with ColumnarFile in a single block.
+    -- delimiter: Field delimiter; defaults to "," for .csv files, tab otherwise.
+    """
+    if path.endswith(columnar_extension):
+        with ColumnarFile(path) as columnar:
+            yield columnar.fieldnames, [columnar.column(name) for name in columnar.fieldnames]
+        return
+    if delimiter is None:
+        delimiter = default_delimiter(path)
+    with open_file(path, "r") as infile:
+        reader = csv.reader(infile, delimiter=delimiter)
+        fieldnames = next(reader, [])
+        width = len(fieldnames)
+        empty = True
+        while True:
+            rows = list(itertools.islice(reader, block_rows))
+            if not rows:
+                break
+            extras = None
+            if set(map(len, rows)) != {width}:
+                # Skip blank lines and fit short or long rows to the header
+                rows = [row for row in rows if row]
+                if any(len(row) > width for row in rows):
+                    extras = [row[width:] or missing_cell for row in rows]
+                rows = [(row + [None] * (width - len(row)))[:width] for row in rows]
+            if rows:
+                empty = False
+                columns = [list(column) for column in zip(*rows)]
+                if extras is not None:
+                    yield fieldnames + [None], columns + [extras]
+                else:
+                    yield fieldnames, columns
+        if empty:
+            yield fieldnames, [[] for field in fieldnames]
+
+
+def TSV2table(path, delimiter=None):
+    """
+    Makes a Table out of a TSV input and returns it, with the same indices and
+    row contents as TSV2dict. The file is read in blocks with iter_blocks.
+
+    -- path: Path of TSV to be turned into a Table; .gz, .xz and .zst files
+       are decompressed and .adpc files are memory-mapped.
+    -- delimiter: Field delimiter; defaults to "," for .csv files, tab otherwise.
+    -- Returns the Table.
+    """
+    table = None
+    # The rows of each block are short-lived lists, so cyclic garbage
+    # collection would only rescan the growing table while reading
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for fieldnames, columns in iter_blocks(path, delimiter):
+            if table is None:
+                has_index = "index" in fieldnames
+                table = Table(fieldnames if has_index else fieldnames + ["index"])
+            block = dict(zip(fieldnames, columns))
+            row_count = len(columns[0]) if columns else 0
+            if has_index:
+                indices = [int(index) for index in block["index"]]
+            else:
+                indices = list(range(len(table), len(table) + row_count))
+                block["index"] = indices
+            for name in block:
+                # e.g., the None field of extra cells, first seen in a later block
+                if name not in table.columns:
+                    table.columns[name] = [missing_cell] * len(table)
+            table.extend(indices, [block.get(name, [missing_cell] * row_count)
+                                   for name in table.columns])
+    finally:
+        if gc_enabled:
+            gc.enable()
+    count = len(table)
+    print(f"{count} rows added from TSV to table.")
+    return table
+
+
+def TSV2dict(path, delimiter=None):
     """
     Makes a dict out of a TSV input and returns it. The output dict has indices
     for keys and dicts for the corresponding row of data as its values. Those
     dicts have column headers as their keys and the data in those columns
     for the values.
 
-    -- path: Path of TSV to be turned into a dict.
+    -- path: Path of TSV to be turned into a dict; .gz, .xz and .zst files
+       are decompressed and .adpc files are memory-mapped.
+    -- delimiter: Field delimiter; defaults to "," for .csv files, tab otherwise.
     -- Returns the dict.
     """
-    with open(path, "r", encoding="UTF-8") as infile:
-        reader = csv.DictReader(infile, delimiter="\t")
-        data = {}
+    data = dict(iter_TSV(path, delimiter))
+    count = len(data.keys())
+    print(f"{count} rows added from TSV to dict.")
+    return data
+
+
+def iter_TSV(path, delimiter=None):
+    """
+    Reads a TSV one row at a time, yielding the (index, row dict) pairs that
+    TSV2dict would collect, so that the whole file is never held in memory.
+
+    -- path: Path of TSV to be read; .gz, .xz and .zst files are decompressed
+       and .adpc files are memory-mapped.
+    -- delimiter: Field delimiter; defaults to "," for .csv files, tab otherwise.
+    """
+    infile = None
+    if path.endswith(columnar_extension):
+        # Only each column's distinct values and row codes are held in memory
+        with ColumnarFile(path) as columnar:
+            fieldnames = columnar.fieldnames
+            columns = [map(columnar.values(name).__getitem__, columnar.codes(name))
+                       for name in fieldnames]
+        reader = (dict(zip(fieldnames, values)) for values in zip(*columns))
+    else:
+        infile = open_file(path, "r")
+        reader = csv.DictReader(infile, delimiter=delimiter or default_delimiter(path))
+    try:
         newindex = 0
         for row in reader:
             if "index" not in row:
-                data[newindex] = {}
-                for i in row:
-                    data[newindex][i] = row[i]
-                data[newindex]["index"] = newindex
+                row["index"] = newindex
+                yield newindex, row
                 newindex += 1
             else:
-                index = int(row["index"])
-                data[index] = {}
-                for i in row:
-                    data[index][i] = row[i]
-        count = len(data.keys())
-        print(f"{count} rows added from TSV to dict.")
-        return data
+                yield int(row["index"]), row
+    finally:
+        if infile is not None:
+            infile.close()
 
 
 def dict2TSV(xdict, path):
     """
-    Makes a TSV from a dict input in the format created by TSV2dict.
+    Makes a TSV from a dict input in the format created by TSV2dict, or from a
+    Table, whose columns are written out directly.
 
     -- xdict: Name of the dict to be turned into a TSV.
-    -- path: Path of output TSV.
+    -- path: Path of output TSV, compressed if it ends in .gz, .xz or .zst, or
+       written with dict2columnar if it ends in .adpc.
     """
+    if path.endswith(columnar_extension):
+        return dict2columnar(xdict, path)
     indices = [i for i in xdict.keys()]
     first = indices[0]
     fieldnames = [i for i in xdict[first].keys()]
-    with open(path, "w", newline="\n", encoding='utf-8') as tsv:
-        writer = csv.DictWriter(tsv, fieldnames=fieldnames, delimiter="\t")
-        writer.writeheader()
-        for (index, row) in xdict.items():
+    with open_file(path, "w", newline="\n") as tsv:
+        if type(xdict) is Table:
+            for name, column in xdict.columns.items():
+                if name not in fieldnames and any(value is not missing_cell for value in column):
+                    raise ValueError(f"dict contains fields not in fieldnames: {name!r}")
+            columns = [xdict.columns[name] for name in fieldnames]
+            # Missing cells are written empty, as csv.DictWriter writes absent keys
+            columns = [["" if value is missing_cell else value for value in column]
+                       if missing_cell in column else column for column in columns]
+            writer = csv.writer(tsv, delimiter="\t")
+            writer.writerow(fieldnames)
+            writer.writerows(zip(*columns))
+        else:
+            writer = csv.DictWriter(tsv, fieldnames=fieldnames, delimiter="\t")
+            writer.writeheader()
+            writer.writerows(xdict.values())
+        print(f"{path} written and saved.")
+
+
+def stream2TSV(rows, path):
+    """
+    Makes a TSV from a stream of (index, row dict) pairs, writing each row as
+    it arrives. The header is taken from the first row.
+
+    -- rows: Iterable of (index, row dict) pairs, e.g., from iter_TSV.
+    -- path: Path of output TSV, compressed if it ends in .gz, .xz or .zst.
+    """
+    if path.endswith(columnar_extension):
+        raise ValueError(f"{path}: columnar files are written from a whole table, not a stream.")
+    with open_file(path, "w", newline="\n") as tsv:
+        writer = None
+        for (index, row) in rows:
+            if writer is None:
+                writer = csv.DictWriter(tsv, fieldnames=list(row.keys()), delimiter="\t")
+                writer.writeheader()
+            writer.writerow(row)
+        print(f"{path} written and saved.")
+
+
+def tee2TSV(rows, path):
+    """
+    Passes a stream of (index, row dict) pairs through unchanged while also
+    writing each row to a TSV, e.g., to keep an intermediate stage's output.
+
+    Rows are written before they are yielded, so the TSV holds each row as it
+    was when it left the stage.
+
+    -- rows: Iterable of (index, row dict) pairs.
+    -- path: Path of output TSV, compressed if it ends in .gz, .xz or .zst.
+    """
+    if path.endswith(columnar_extension):
+        raise ValueError(f"{path}: columnar files are written from a whole table, not a stream.")
+    with open_file(path, "w", newline="\n") as tsv:
+        writer = None
+        for (index, row) in rows:
+            if writer is None:
+                writer = csv.DictWriter(tsv, fieldnames=list(row.keys()), delimiter="\t")
+                writer.writeheader()
             writer.writerow(row)
+            yield index, row
         print(f"{path} written and saved.")
@@ -1,79 +1,154 @@
 import re
+from collections.abc import MutableMapping
 
 
 def validity_score(data_dict):
-    index_mappings = {}
-    for index, rowdict in data_dict.items():
-        og_id = rowdict["original_index"]
-        split_id = rowdict["index"]
-        if og_id not in index_mappings.keys():
-            index_mappings[og_id] = {}
-            index_mappings[og_id]["id_list"] = []
-        index_mappings[og_id]["id_list"].append(int(split_id))
-    for og_id, index_data in index_mappings.items():
-        stopped = False
-        total_items = 0
-        valid_items = 0
-        for i in index_data["id_list"]:
-            total_items += 1
-            if data_dict[i]["phrase_validation"] == "stopped":
-                stopped = True
-                break
-            elif data_dict[i]["phrase_validation"] == "pass":
-                valid_items += 1
-        if not stopped:
-            index_data["phrase_validity_rate"] = round(valid_items/total_items, 2)
-            index_data["split_phrase_count"] = total_items
-        else:
-            index_data["phrase_validity_rate"] = ""
-            index_data["split_phrase_count"] = ""
-    og_ids = []
+    """
+    Gives the first split row of each original data item its split_phrase_count
+    and phrase_validity_rate, grouping rows by original_index in one pass.
+    """
+    groups = {}
     for index, rowdict in data_dict.items():
-        lookup_index = rowdict["original_index"]
-        if lookup_index not in og_ids:
-            rowdict["split_phrase_count"] = index_mappings[lookup_index]["split_phrase_count"]
-            rowdict["phrase_validity_rate"] = index_mappings[lookup_index]["phrase_validity_rate"]
-            og_ids.append(lookup_index)
+        groups.setdefault(rowdict["original_index"], []).append(rowdict)
+    for group in groups.values():
+        score_split_group(group)
+
+
+def score_split_group(group):
+    """
+    Scores the split rows of one original data item, giving the first row its
+    split_phrase_count and phrase_validity_rate and blanking them on the rest.
+    """
+    stopped = False
+    total_items = 0
+    valid_items = 0
+    for rowdict in group:
+        total_items += 1
+        if rowdict["phrase_validation"] == "stopped":
+            stopped = True
+            break
+        elif rowdict["phrase_validation"] == "pass":
+            valid_items += 1
+    for i, rowdict in enumerate(group):
+        if i == 0 and not stopped:
+            rowdict["split_phrase_count"] = total_items
+            rowdict["phrase_validity_rate"] = round(valid_items/total_items, 2)
         else:
             rowdict["split_phrase_count"] = ""
             rowdict["phrase_validity_rate"] = ""
 
 
+def iter_validity_score(rows):
+    """
+    Streaming form of validity_score. Relies on the split rows of each original
+    data item arriving together, as iter_reindex_by_split yields them, so only
+    one item's rows are held at a time.
+    """
+    group = []
+    for index, rowdict in rows:
+        if group and group[0][1]["original_index"] != rowdict["original_index"]:
+            score_split_group([row for i, row in group])
+            yield from group
+            group = []
+        group.append((index, rowdict))
+    if group:
+        score_split_group([row for i, row in group])
+        yield from group
+
+
+class SplitRow(MutableMapping):
+    """
+    One split phrase of a data_loc row, sharing the columns of its parent row.
+
+    Only index, original_index, split_phrase and any columns set after
+    splitting are stored on the split row; every other column is read from the
+    parent row. Keys are ordered index, original_index, the parent's columns,
+    then the split row's own columns.
+    """
+
+    __slots__ = ("parent", "own", "hidden")
+    lead = ("index", "original_index")
+
+    def __init__(self, parent, own):
+        self.parent = parent
+        self.own = own
+        # Parent columns deleted from this split row
+        self.hidden = frozenset()
+
+    def __getitem__(self, key):
+        if key in self.own:
+            return self.own[key]
+        if key in self.hidden or key == "index":
+            raise KeyError(key)
+        return self.parent[key]
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+        if key in self.hidden:
+            self.hidden = self.hidden - {key}
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.own.pop(key, None)
+        if key in self.parent:
+            self.hidden = self.hidden | {key}
+
+    def __contains__(self, key):
+        if key in self.own:
+            return True
+        return key not in self.hidden and key != "index" and key in self.parent
+
+    def __iter__(self):
+        for key in self.lead:
+            if key in self:
+                yield key
+        for key in self.parent:
+            if key not in self.lead and key not in self.hidden:
+                yield key
+        for key in self.own:
+            if key not in self.lead and key not in self.parent:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
 
 def reindex_by_split(data_dict, target_column):
+    return dict(iter_reindex_by_split(data_dict.items(), target_column))
+
+
+def iter_reindex_by_split(rows, target_column):
+    """
+    Streaming form of reindex_by_split: takes (index, row dict) pairs and
+    yields one (split index, SplitRow) pair per split phrase.
+    """
     split_index = 0
-    new_data_dict = {}
-    for unsplit_index, rowdict in data_dict.items():
+    for unsplit_index, rowdict in rows:
         data_item = rowdict[target_column]
         if type(data_item) is str:
-            new_data_dict[split_index] = {}
-            new_data_dict[split_index]["index"] = split_index
-            new_data_dict[split_index]["original_index"] = unsplit_index
-            for key, value in rowdict.items():
-                if key != "index":
-                    new_data_dict[split_index][key] = value
-            new_data_dict[split_index]["split_phrase"] = data_item
+            own = {"index": split_index, "original_index": unsplit_index}
+            own["split_phrase"] = data_item
+            yield split_index, SplitRow(rowdict, own)
             split_index += 1
         elif type(data_item) is list:
             iterator = 0
             for item in data_item:
-                new_data_dict[split_index] = {}
-                new_data_dict[split_index]["index"] = split_index
-                new_data_dict[split_index]["original_index"] = unsplit_index
-                for key, value in rowdict.items():
-                    if key != "index":
-                        if iterator != 0 and key in [
-                                    "char_validation",
-                                    "word_validation",
-                                    "char_distance_score",
-                                    "word_distance_score"]:
-                            new_data_dict[split_index][key] = ""
-                        else:
-                            new_data_dict[split_index][key] = value
-                new_data_dict[split_index]["split_phrase"] = item
+                own = {"index": split_index, "original_index": unsplit_index}
+                if iterator != 0:
+                    for key in ["char_validation",
+                                "word_validation",
+                                "char_distance_score",
+                                "word_distance_score"]:
+                        if key in rowdict:
+                            own[key] = ""
+                own["split_phrase"] = item
+                yield split_index, SplitRow(rowdict, own)
                 split_index += 1
                 iterator += 1
-    return new_data_dict
 
 
 def approved_and_phrases(query_string_list):
@@ -91,127 +166,156 @@ def approved_and_phrases(query_string_list):
     return query_string_list
 
 
-def split_data_loc(string):
+location_prefixes = ["extended data",
+                      "supplemental",
+                      "supplementary",
+                      "supporting",
+                      "additional",
+                      "extended"]
+location_types = ["data", "file", "figure", "table", "information", "page", "pdb"]
+
+
+class DataLocSplitter:
     """
-    Normalize localization phrases in a given text by identifying combined
-    prefixes and types and associating numbers to these types across segments
-    split by commas, semicolons, or "and". Both prefixes and types are dynamic.
+    Splits data_loc strings into normalized localization phrases.
+
+    Every pattern is built and compiled once, from the prefixes and types
+    given, or location_prefixes and location_types by default.
+    """
+
+    def __init__(self, prefixes=None, types=None):
+        if prefixes is None:
+            prefixes = location_prefixes
+        if types is None:
+            types = location_types
+        # Convert lists of prefixes and types into regex patterns, escaping each entry properly
+        prefixes_pattern = r"(?:" + "|".join(re.escape(prefix) for prefix in prefixes) + r")\s+"
+        types_pattern = "|".join(re.escape(type) for type in types)
+        # Full pattern that optionally captures any prefix followed by any type
+        self.full_types = re.compile(r"(" + prefixes_pattern + r")?(" + types_pattern + r")",
+                                     re.IGNORECASE)
+        self.end_punctuation = re.compile(r"(\.|,)+$")
+        self.number_letter = re.compile(r"\b([0-9]+)\.?\s([a-z])\b")
+        self.delimiter = re.compile(r",|;| and ")
+        self.version_tag = re.compile(r"\(v\d+(\.\d+)?\)")
+        self.text_page = re.compile(r"text p\.?\s*(\d+)")
+        self.pdb_id = re.compile(r"\b(pdb[: ]\s*)?([0-9][a-zA-Z0-9]{2}[a-zA-Z]|[0-9][a-zA-Z0-9][a-zA-Z][a-zA-Z0-9]|[0-9][a-zA-Z][a-zA-Z0-9]{2})\b")
+        self.number = re.compile(r"\bs?\d+[a-zA-Z]?(?:[\s&-]*[a-zA-Z0-9])*\b")
+        self.base_number = re.compile(r"s?\d+")
+        self.numeric_range = re.compile(r"\d-\d")
+        self.digits = re.compile(r"\d+")
+        self.alphanumeric_range = re.compile(r"(\d+)([a-z])-([a-z])")
+        self.letter = re.compile(r"\b[a-zA-Z]\b")
+
+    def split(self, string):
+        """
+        Normalize localization phrases in a given text by identifying combined
+        prefixes and types and associating numbers to these types across segments
+        split by commas, semicolons, or "and". Both prefixes and types are dynamic.
+
+        Args:
+        string (str): Input text containing localization phrases that need
+        normalization.
+
+        Returns:
+        list: A list of normalized localization phrases.
+        """
+        # Removes punctuation at the end of a string
+        string = self.end_punctuation.sub(r"", string)
+
+        string = self.number_letter.sub(r"\1\2", string)
+
+        # Normalizing the text by replacing all delimiters with ";"
+        text = self.delimiter.sub(";", string)
+        # Split the text using ";" and remove any empty segments or segments that contain only spaces
+        segments = [segment.strip() for segment in text.split(";") if segment.strip()]
+
+        results = []
+        current_type = None
+        base_number = None
+
+        for segment in segments:
+            # Remove superfluous version tags
+            segment = self.version_tag.sub("", segment).strip()
+
+            # Remove hanging periods leftover from abbreviations
+            segment = segment.replace(". ", " ")
 
-    Args:
-    string (str): Input text containing localization phrases that need
-    normalization.
+            # Replace "text p#|text p #|text p #" with "page #"
+            segment = self.text_page.sub(r"page \1", segment)
 
-    Returns:
-    list: A list of normalized localization phrases.
+            # Fit PDB identifiers with the correct prefix, ensuring at least one letter in the sequence
+            segment = self.pdb_id.sub(r"pdb \2", segment)
+
+            # Detect the presence of a full type (prefix + type) and capture it
+            type_match = self.full_types.search(segment)
+            if type_match:
+                prefix = type_match.group(1) or ""
+                type = type_match.group(2)
+                current_type = f"{prefix}{type}".strip()
+
+            # After identifying the type, extract all numbers from the segment
+            numbers = self.number.findall(segment)
+            for number in numbers:
+                if r"&" in number:
+                    base_number = self.base_number.match(number).group(0)
+                    parts = number.split("&")
+                    for i, part in enumerate(parts):
+                        results.append(f"{current_type} {base_number}{part}" if i != 0 else f"{current_type} {part}")
+                elif self.numeric_range.match(number):
+                    range_ends = self.digits.findall(number)
+                    for i in range(int(range_ends[0]), int(range_ends[1])+1):
+                        results.append(f"{current_type} {i}")
+                elif self.alphanumeric_range.match(number):
+                    alphanumeric_range = self.alphanumeric_range.match(number)
+                    base_number = alphanumeric_range.group(1)
+                    start_letter = alphanumeric_range.group(2)
+                    end_letter = alphanumeric_range.group(3)
+                    for i in range(ord(start_letter), ord(end_letter) + 1):
+                        results.append(f"{current_type} {base_number}{chr(i)}")
+                elif current_type:
+                    results.append(f"{current_type} {number}")
+                    base_number = self.base_number.match(number).group(0)
+                else:
+                    results.append(number)
+                    base_number = self.base_number.match(number).group(0)
+
+            # Look for individual letters for cases like "figure 1a, b, c"
+            individual_letters = self.letter.findall(segment)
+            for letter in individual_letters:
+                if base_number and current_type:
+                    results.append(f"{current_type} {base_number}{letter}")
+                elif base_number:
+                    results.append(f"{base_number}{letter}")
+
+            # If no numbers are found but a type is defined in the segment, treat as type element
+            if not numbers and not individual_letters and type_match:
+                results.append(segment)
+
+            # If no numbers are found and no type is defined in the segment, treat as non-type element
+            if not numbers and not individual_letters and not type_match:
+                # TODO: Decide if we want to keep the "UNNORMALIZED" tag
+                # if original_segment == segment:
+                #    segment = f"UNNORMALIZED: {segment}"
+                results.append(segment)
+
+        # Testing checks for acceptable "x and y" cases (e.g. "materials and methods")
+        results = approved_and_phrases(results)
+
+        return results
+
+    def split_many(self, strings):
+        """
+        Split each string in strings, returning a list of the lists of phrases.
+        """
+        return [self.split(string) for string in strings]
+
+
+default_splitter = DataLocSplitter()
+
+
+def split_data_loc(string):
+    """
+    Split a data_loc string with the default DataLocSplitter.
     """
-    # Convert lists of prefixes and types into regex patterns, escaping each entry properly
-    prefixes = ["extended data",
-                "supplemental",
-                "supplementary",
-                "supporting",
-                "additional",
-                "extended"]
-    types = ["data", "file", "figure", "table", "information", "page", "pdb"]
-    prefixes_pattern = r"(?:" + "|".join(re.escape(prefix) for prefix in prefixes) + r")\s+"
-    types_pattern = "|".join(re.escape(type) for type in types)
-
-    # Full pattern that optionally captures any prefix followed by any type
-    full_types_pattern = r"(" + prefixes_pattern + r")?(" + types_pattern + r")"
-
-    # Removes punctuation at the end of a string
-    string = re.sub(r"(\.|,)+$", r"", string)
-
-    string = re.sub(r"\b([0-9]+)\.?\s([a-z])\b", r"\1\2", string)
-
-    # Normalizing the text by replacing all delimiters with ";"
-    text = re.sub(r",|;| and ", ";", string)
-    # Split the text using ";" and remove any empty segments or segments that contain only spaces
-    segments = [segment.strip() for segment in text.split(";") if segment.strip()]
-
-    results = []
-    current_type = None
-    base_number = None
-
-    for segment in segments:
-        original_segment = segment.strip()
-
-        # Special check for superfluous version tags and remove them
-        if re.search(r"\(v\d+(\.\d+)?\)", original_segment):
-            segment = re.sub(r"\(v\d+(\.\d+)?\)", "", original_segment).strip()
-
-        # Check for hanging periods leftover from abbreviations and remove them
-        if re.search(r"\. ", segment):
-            segment = re.sub(r"\. ", " ", segment)
-
-        # Special check for "text p#|text p #|text p #" and replace with "page #"
-        pattern = r"text p\.?\s*(\d+)"
-        replacement = r"page \1"
-        if re.search(pattern, segment):
-            segment = re.sub(pattern, replacement, segment)
-
-        # Fit PDB identifiers with the correct prefix, ensuring at least one letter in the sequence
-        pattern = r"\b(pdb[: ]\s*)?([0-9][a-zA-Z0-9]{2}[a-zA-Z]|[0-9][a-zA-Z0-9][a-zA-Z][a-zA-Z0-9]|[0-9][a-zA-Z][a-zA-Z0-9]{2})\b"
-
-        def replace(match):
-            # Return formatted string with "pdb " followed by the identifier
-            return f"pdb {match.group(2)}"
-        # Replace the segment using the custom replace function
-        if re.search(pattern, segment):
-            segment = re.sub(pattern, replace, segment)
-
-        # Detect the presence of a full type (prefix + type) and capture it
-        type_match = re.search(full_types_pattern, segment, re.IGNORECASE)
-        if type_match:
-            prefix = type_match.group(1) or ""
-            type = type_match.group(2)
-            current_type = f"{prefix}{type}".strip()
-
-        # After identifying the type, extract all numbers from the segment
-        numbers = re.findall(r"\bs?\d+[a-zA-Z]?(?:[\s&-]*[a-zA-Z0-9])*\b", segment)
-        for number in numbers:
-            if r"&" in number:
-                base_number = re.match(r"s?\d+", number).group(0)
-                parts = re.split(r"&", number)
-                for i, part in enumerate(parts):
-                    results.append(f"{current_type} {base_number}{part}" if i != 0 else f"{current_type} {part}")
-            elif re.match(r"\d-\d", number):
-                range_ends = re.findall(r"\d+", number)
-                for i in range(int(range_ends[0]), int(range_ends[1])+1):
-                    results.append(f"{current_type} {i}")
-            elif re.match(r"\d+[a-z]-[a-z]", number):
-                alphanumeric_range = re.match(r"(\d+)([a-z])-([a-z])", number)
-                base_number = alphanumeric_range.group(1)
-                start_letter = alphanumeric_range.group(2)
-                end_letter = alphanumeric_range.group(3)
-                for i in range(ord(start_letter), ord(end_letter) + 1):
-                    results.append(f"{current_type} {base_number}{chr(i)}")
-            elif current_type:
-                results.append(f"{current_type} {number}")
-                base_number = re.match(r"s?\d+", number).group(0)
-            else:
-                results.append(number)
-                base_number = re.match(r"s?\d+", number).group(0)
-
-        # Look for individual letters for cases like "figure 1a, b, c"
-        individual_letters = re.findall(r"\b[a-zA-Z]\b", segment)
-        for letter in individual_letters:
-            if base_number and current_type:
-                results.append(f"{current_type} {base_number}{letter}")
-            elif base_number:
-                results.append(f"{base_number}{letter}")
-
-        # If no numbers are found but a type is defined in the segment, treat as type element
-        if not numbers and not individual_letters and type_match:
-            results.append(segment)
-
-        # If no numbers are found and no type is defined in the segment, treat as non-type element
-        if not numbers and not individual_letters and not type_match:
-            # TODO: Decide if we want to keep the "UNNORMALIZED" tag
-            # if original_segment == segment:
-            #    segment = f"UNNORMALIZED: {segment}"
-            results.append(segment)
-
-    # Testing checks for acceptable "x and y" cases (e.g. "materials and methods")
-    results = approved_and_phrases(results)
-
-    return results
+    return default_splitter.split(string)
@@ -1,7 +1,7 @@
 import os
 import sys
 import re
-from converter import TSV2dict, dict2TSV
+from converter import TSV2table, dict2TSV, resolve_path
 
 
 def make_part_index(data_dict):
@@ -96,9 +96,9 @@ def unsplit(data_dict, original_column):
 def main():
     style = sys.argv[1]
     original_column = sys.argv[2]
-    infile = os.path.join(style, "output_files", f"p_norm_{style}.tsv")
+    infile = resolve_path(os.path.join(style, "output_files", f"p_norm_{style}.tsv"))
     outfile = os.path.join(style, "output_files", "p_norm_data_loc_clean.tsv")
-    data_dict = TSV2dict(infile)
+    data_dict = TSV2table(infile)
     data_dict = unsplit(data_dict, original_column)
     dict2TSV(data_dict, outfile)
 
@@ -1,36 +1,43 @@
+import argparse
 import os
 import re
 import sys
 import data_loc_splitter as dls
 import toolkit as tk
-from converter import TSV2dict, dict2TSV
+from converter import TSV2dict, TSV2table, data_path, dict2TSV, resolve_path
 
 separator = r"[-,\():;\s]+"
 
 
-def find_category(word, word_review_dict, word_reference_dict):
+number_regex = re.compile(r"\d+\.?\d*")
+
+
+def build_category_map(word_reference_dict):
+    """
+    Map each word in word_reference to its category, or "unknown" if it has none.
+
+    The first row logging a word wins, as with tk.lookup.
+    """
+    category_map = {}
+    for index, rowdict in word_reference_dict.items():
+        word = rowdict["unknown_word"]
+        if word not in category_map:
+            category_map[word] = rowdict["category"] if rowdict["category"] != "" else "unknown"
+    return category_map
+
+
+def find_category(word, category_map):
     """
     Identify the category of a word based on word_reference category column.
+
+    category_map is made by build_category_map.
     """
-    number_regex = r"\d+\.?\d*"
-    number = re.fullmatch(number_regex, word)
-    if number:
+    if number_regex.fullmatch(word):
         return "number"
-    else:
-        source, location = tk.lookup(word,
-                                     word_review_dict,
-                                     word_reference_dict,
-                                     "word")
-        if source == "reference":
-            if word_reference_dict[location]["category"] != "":
-                return word_reference_dict[location]["category"]
-            else:
-                return "unknown"
-        else:
-            return "unknown"
+    return category_map.get(word, "unknown")
 
 
-def build_phrase_dict(string, separator):
+def build_phrase_dict(string, separator, category_map):
     """
     Construct a dict of information about each word in a phrase.
     """
@@ -52,9 +59,7 @@ def build_phrase_dict(string, separator):
             phrase_dict[i] = {}
             phrase_dict[i]["index"] = 0
             phrase_dict[i]["word"] = string_parts[i]
-            phrase_dict[i]["category"] = find_category(string_parts[i],
-                                                       word_review_dict,
-                                                       word_reference_dict)
+            phrase_dict[i]["category"] = find_category(string_parts[i], category_map)
             if i in range(len(separators)):
                 phrase_dict[i]["separator"] = separators[i]
             else:
@@ -74,33 +79,173 @@ def make_categorization_string(phrase_dict):
     return cat_string
 
 
-def phrase_lookup(cat_string):
+def parse_standard_form(standard_form):
+    """
+    Split a standard form into a template of literal text and word slots.
+
+    Literal pieces are strings and slots are the int positions of the words
+    they refer to, e.g., "[0] [1]" becomes [0, " ", 1].
+    """
+    template = []
+    for i, piece in enumerate(re.split(r"\[(\d+)\]", standard_form)):
+        if i % 2 == 1:
+            template.append(int(piece))
+        elif piece != "":
+            template.append(piece)
+    return template
+
+
+pattern_token = re.compile(r"\[([^\[\]]*)\((\d+)\)\]([?+*]?)")
+
+
+def parse_pattern(pattern):
+    """
+    Split a type sheet pattern into (category, slot, quantifier) tokens.
+
+    Returns None if pattern is not a sequence of tokens like [unit(1)] or
+    [number(0)]+.
+    """
+    tokens = []
+    end = 0
+    for match in pattern_token.finditer(pattern):
+        if match.start() != end:
+            return None
+        tokens.append((match.group(1), int(match.group(2)), match.group(3)))
+        end = match.end()
+    if end != len(pattern) or not tokens:
+        return None
+    return tokens
+
+
+def join_words(phrase_dict, start, end):
+    """
+    Join the words of phrase_dict from start up to end with the separators
+    found between them in the original phrase.
+    """
+    if start == -1:
+        return ""
+    phrase = ""
+    for i in range(start, end):
+        phrase += phrase_dict[i]["word"]
+        if i < end - 1:
+            phrase += phrase_dict[i]["separator"]
+    return phrase
+
+
+class PhraseTypes:
+    """
+    The phrase type sheet compiled for matching phrases.
+
+    Patterns made only of plain categories are kept in a dict keyed by
+    pattern. Patterns using a wildcard category ([*(0)]) or a quantifier after
+    a category ([number(0)]?, [number(0)]+, [number(0)]*) are compiled into
+    one regex, tried in sheet order, over a phrase's categories written one
+    character per category. The first row with a given pattern wins, and an
+    exact pattern wins over the regex.
+    """
+
+    def __init__(self, type_dict):
+        self.exact = {}
+        self.exact_rows = {}
+        self.codes = {}
+        self.grammar_rows = {}
+        alternatives = []
+        for index, rowdict in type_dict.items():
+            pattern = rowdict["pattern"]
+            entry = (rowdict["name"],
+                     rowdict["valid?"],
+                     parse_standard_form(rowdict["standard_form"]))
+            sheet_row = (pattern, rowdict["name"], rowdict["valid?"], rowdict["standard_form"])
+            tokens = parse_pattern(pattern)
+            if tokens is None or all(q == "" and cat != "*" for cat, slot, q in tokens):
+                self.exact.setdefault(pattern, entry)
+                self.exact_rows.setdefault(pattern, sheet_row)
+                continue
+            row = f"r{len(self.grammar_rows)}"
+            slot_groups = []
+            regex = ""
+            for category, slot, quantifier in tokens:
+                atom = "." if category == "*" else re.escape(self.code(category))
+                if slot in [s for s, group in slot_groups]:
+                    regex += f"(?:{atom}{quantifier})"
+                else:
+                    group = f"{row}s{slot}"
+                    slot_groups.append((slot, group))
+                    regex += f"(?P<{group}>{atom}{quantifier})"
+            alternatives.append(f"(?P<{row}>{regex})")
+            self.grammar_rows[row] = entry, slot_groups, sheet_row
+        self.other = chr(0xE000 + len(self.codes))
+        self.grammar = re.compile("|".join(alternatives), re.DOTALL) if alternatives else None
+
+    def code(self, category):
+        """
+        Return the character standing for category in the compiled regex.
+        """
+        if category not in self.codes:
+            self.codes[category] = chr(0xE000 + len(self.codes))
+        return self.codes[category]
+
+    def match_grammar(self, categories):
+        """
+        Match a phrase's list of word categories against the compiled regex.
+        """
+        if self.grammar is None:
+            return None
+        return self.grammar.fullmatch("".join(self.codes.get(category, self.other)
+                                              for category in categories))
+
+    def match(self, cat_string, phrase_dict):
+        """
+        Find the phrase type of a phrase.
+
+        Returns its name, validity and standard form template, and a dict of
+        the text each slot of the template is filled with.
+        """
+        entry = self.exact.get(cat_string)
+        if entry is not None:
+            slots = {i: word_dict["word"] for i, word_dict in phrase_dict.items()}
+            return (*entry, slots)
+        match = self.match_grammar(word_dict["category"] for word_dict in phrase_dict.values())
+        if match:
+            entry, slot_groups, sheet_row = self.grammar_rows[match.lastgroup]
+            slots = {slot: join_words(phrase_dict, *match.span(group))
+                     for slot, group in slot_groups}
+            return (*entry, slots)
+        return "unknown", "N", [], {}
+
+    def matched_row(self, cat_string, categories):
+        """
+        Return the pattern, name, validity and standard form of the sheet row
+        a phrase with cat_string and list of word categories matches, or None.
+        """
+        if cat_string in self.exact_rows:
+            return self.exact_rows[cat_string]
+        match = self.match_grammar(categories)
+        if match:
+            return self.grammar_rows[match.lastgroup][2]
+        return None
+
+
+def phrase_lookup(cat_string, phrase_dict, phrase_types):
     """
     Check cat_string against patterns specified in type sheet.
+
+    phrase_types is a PhraseTypes.
     """
-    matched = False
-    for index, rowdict in type_dict.items():
-        pattern = rowdict["pattern"]
-        if cat_string == pattern:
-            return rowdict["name"], rowdict["valid?"], rowdict["standard_form"]
-            matched = True
-            break
-    if not matched:
-        return "unknown", "N", ""
+    return phrase_types.match(cat_string, phrase_dict)
 
 
-def rearrange_phrase(cat_string, rowdict, phrase_dict, output_column, style):
+def rearrange_phrase(cat_string, rowdict, phrase_dict, output_column, style, phrase_types):
     """
     Configure the words in cat_string according to the specified standard form.
     """
-    p_type, validity, standard_form = phrase_lookup(cat_string)
+    p_type, validity, template, slots = phrase_lookup(cat_string, phrase_dict, phrase_types)
     rowdict["phrase_type"] = p_type
     rowdict["phrase_validation"] = "pass" if validity == "Y" else "fail"
-    phrase = standard_form
-    match_list = re.findall(r"\d+", standard_form)
-    for match in match_list:
-        referent = phrase_dict[int(match)]["word"]
-        phrase = re.sub(fr"\[{match}\]", referent, phrase)
+    phrase = "".join(slots[piece] if type(piece) is int else piece for piece in template)
+    if any(slots[piece] == "" for piece in template if type(piece) is int):
+        # An optional slot that matched nothing leaves its separators behind
+        phrase = tk.normalize_whitespace(phrase)
     if style == "age":
         phrase = tk.pluralize_unit(phrase, p_type)
     rowdict[output_column] = phrase
@@ -121,54 +266,301 @@ def create_phrase_type_sheet(path):
     dict2TSV(type_dict, path)
 
 
-def normalize_phrase(style, data_file, original_column):
+def normalize_phrase(style, data_file, original_column, type_file, word_review_file,
+                     word_reference_file, dedup=False, compress=None, columnar=False,
+                     cache_dir=None, stage_cache_dir=None, memo_path=None):
     """
     Apply phrase normalization to the word-normalized data column in data_file.
+
+    Reads the phrase type sheet, creating it first if needed, and the word
+    review & reference files, normalizes the data with normalize_phrase_data,
+    and writes the output file, compressed with compress if it is "gz", "xz"
+    or "zst", or in the binary columnar format if columnar is True.
+    See iter_normalize_phrase for cache_dir and memo_path.
+
+    If stage_cache_dir is given, the output file is kept in a tk.StageCache
+    there, and restored from it instead of normalizing when the data file,
+    sheets and settings match an earlier run.
+    """
+    if not os.path.isfile(type_file):
+        create_phrase_type_sheet(type_file)
+    output_path = data_path(os.path.join(style, "output_files", f"p_norm_{style}.tsv"),
+                            compress, columnar)
+    if stage_cache_dir is not None:
+        stage_cache = tk.StageCache(stage_cache_dir)
+        key = stage_cache.key("phrase",
+                              [data_file, type_file, word_review_file, word_reference_file],
+                              [output_path], (original_column, dedup),
+                              [sys.modules[__name__], dls])
+        if stage_cache.restore(key, [output_path]):
+            return
+    word_review_dict = TSV2dict(word_review_file)
+    word_reference_dict = TSV2dict(word_reference_file)
+    type_dict = TSV2dict(type_file)
+    data_dict = TSV2table(data_file)
+    data_dict = normalize_phrase_data(style,
+                                      data_dict,
+                                      original_column,
+                                      type_dict,
+                                      word_review_dict,
+                                      word_reference_dict,
+                                      dedup,
+                                      cache_dir=cache_dir,
+                                      memo_path=memo_path)
+    dict2TSV(data_dict, output_path)
+    if stage_cache_dir is not None:
+        stage_cache.store(key, [output_path])
+
+
+def normalize_phrase_data(style, data_dict, original_column, type_dict, word_review_dict,
+                          word_reference_dict, dedup=False, workers=1, cache_dir=None,
+                          memo_path=None):
     """
-    target_column = f"word_normalized_{original_column}"
-    output_column = f"phrase_normalized_{original_column}"
-    data_dict = TSV2dict(data_file)
+    Apply phrase normalization to the word-normalized data column in data_dict.
+
+    If dedup is True, each distinct data item is split and normalized once and
+    its result is reused for repeats.
+
+    Returns data_dict, or for data_loc a new dict of SplitRows indexed by
+    split phrase.
+    """
+    rows = iter_normalize_phrase(style,
+                                 data_dict.items(),
+                                 original_column,
+                                 type_dict,
+                                 word_review_dict,
+                                 word_reference_dict,
+                                 dedup,
+                                 workers,
+                                 cache_dir,
+                                 memo_path)
     if style == "data_loc":
-        for index, rowdict in data_dict.items():
-            data_item = rowdict[target_column]
-            invalid = re.match(r"!\s.*\s!", data_item)
-            if invalid:
-                rowdict[f"split_{target_column}"] = data_item
-            else:
-                rowdict[f"split_{target_column}"] = dls.split_data_loc(rowdict[target_column])
-        data_dict = dls.reindex_by_split(data_dict, f"split_{target_column}")
-        target_column = f"split_phrase"
-    for index, rowdict in data_dict.items():
+        return dict(rows)
+    for index, rowdict in rows:
+        data_dict[index] = rowdict
+    return data_dict
+
+
+class PhraseStage:
+    """
+    Phrase normalization rules compiled once per run.
+
+    Only the word reference's categories are used to categorize words, so they
+    are gathered into a word -> category map up front, making categorizing a
+    phrase one dict lookup per word. The phrase type sheet is compiled into a
+    PhraseTypes.
+
+    If cache_dir is given, results are kept there in a tk.ResultCache. Its
+    entries depend on the categories of their words, and are dropped when
+    the type sheet row their categories match has changed. If memo_path is
+    given, results are also kept in a tk.MemoStore in that file, under a
+    version covering every word category and the whole type sheet.
+    """
+
+    def __init__(self, style, original_column, type_dict, word_reference_dict, dedup=False,
+                 cache_dir=None, memo_path=None):
+        self.style = style
+        self.original_column = original_column
+        self.phrase_types = PhraseTypes(type_dict)
+        self.category_map = build_category_map(word_reference_dict)
+        self.dedup = dedup
+        self.cache = None
+        self.memo_store = None
+        if cache_dir is not None or memo_path is not None:
+            settings = ("phrase", style, original_column,
+                        tk.source_digest(sys.modules[__name__], tk, dls))
+        if memo_path is not None:
+            type_rows = [tuple(rowdict.items()) for rowdict in type_dict.values()]
+            self.memo_store = tk.MemoStore(memo_path, style, "phrase",
+                                           tk.rules_version((settings, type_rows),
+                                                            self.category_map))
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f"phrase_{original_column}.json")
+            self.cache = tk.open_result_cache(cache_path, settings)
+            self.cache.refresh(self.category_map, self.is_stale)
+
+    def is_stale(self, check):
+        """
+        Tell whether a cached phrase now matches a different type sheet row.
+        """
+        cat_string, categories, sheet_row = check
+        return self.phrase_types.matched_row(cat_string, categories) != sheet_row
+
+    def iter_rows(self, rows):
+        """
+        Normalize a stream of (index, rowdict) pairs, yielding each row once
+        it is normalized.
+        """
+        target_column = f"word_normalized_{self.original_column}"
+        output_column = f"phrase_normalized_{self.original_column}"
+        if self.style == "data_loc":
+            rows = dls.iter_reindex_by_split(iter_split_data_loc(rows, target_column, self.dedup),
+                                             f"split_{target_column}")
+            target_column = f"split_phrase"
+        rows = iter_phrase_rows(rows,
+                                target_column,
+                                output_column,
+                                self.style,
+                                self.phrase_types,
+                                self.category_map,
+                                self.dedup,
+                                self.cache,
+                                self.memo_store)
+        if self.style == "data_loc":
+            rows = dls.iter_validity_score(rows)
+        return rows
+
+    def save(self):
+        """
+        Write the result cache and memo store, if any, once all rows are
+        normalized.
+        """
+        if self.cache is not None:
+            self.cache.save()
+        if self.memo_store is not None:
+            self.memo_store.save()
+
+    def process_chunk(self, chunk):
+        """
+        Normalize a list of (index, rowdict) pairs in a worker process.
+        """
+        return list(self.iter_rows(chunk))
+
+
+def iter_normalize_phrase(style, rows, original_column, type_dict, word_review_dict,
+                          word_reference_dict, dedup=False, workers=1, cache_dir=None,
+                          memo_path=None):
+    """
+    Apply phrase normalization to the word-normalized data column in a stream
+    of (index, row dict) pairs, yielding each row once it is normalized.
+
+    For data_loc, rows are split and yielded per split phrase, and each data
+    item's split rows are held back until all of them can be scored.
+
+    Words are categorized from word_reference_dict only; categories in
+    word_review_dict take effect once their rows move to the reference.
+
+    If workers is more than 1, rows are normalized in that many processes.
+
+    If cache_dir is given, each distinct phrase's results are kept in a file
+    there, and the next run normalizes again only the phrases with words whose
+    categories have changed or that match a changed type sheet row. This
+    needs a single process.
+
+    If memo_path is given, results are also looked up in and added to an
+    SQLite database there, keyed by style, phrase and a hash of all the word
+    categories and the type sheet, so phrases normalized by any earlier run
+    with the same rules are not normalized again. This also needs a single
+    process.
+    """
+    if workers > 1 and (cache_dir is not None or memo_path is not None):
+        raise ValueError("Results can only be cached when normalizing in one process.")
+    if workers > 1:
+        stage_args = (style, original_column, type_dict, word_reference_dict, dedup)
+        rows = tk.iter_sharded(rows, PhraseStage, stage_args, workers)
+        if style == "data_loc":
+            # Each worker numbers its split rows from 0, so number them again
+            for split_index, (index, rowdict) in enumerate(rows):
+                rowdict["index"] = split_index
+                yield split_index, rowdict
+        else:
+            yield from rows
+    else:
+        stage = PhraseStage(style, original_column, type_dict, word_reference_dict, dedup,
+                            cache_dir, memo_path)
+        yield from stage.iter_rows(rows)
+        stage.save()
+
+
+def iter_split_data_loc(rows, target_column, dedup=False):
+    """
+    Adds the list of split phrases of each valid data_loc item to its row.
+    """
+    split_memo = {}
+    for index, rowdict in rows:
+        data_item = rowdict[target_column]
+        invalid = re.match(r"!\s.*\s!", data_item)
+        if invalid:
+            rowdict[f"split_{target_column}"] = data_item
+        elif dedup and data_item in split_memo:
+            rowdict[f"split_{target_column}"] = split_memo[data_item]
+        else:
+            rowdict[f"split_{target_column}"] = dls.split_data_loc(rowdict[target_column])
+            if dedup:
+                split_memo[data_item] = rowdict[f"split_{target_column}"]
+        yield index, rowdict
+
+
+def iter_phrase_rows(rows, target_column, output_column, style, phrase_types, category_map,
+                     dedup=False, cache=None, memo_store=None):
+    """
+    Categorizes and rearranges the phrase in target_column of each row.
+
+    If cache is a tk.ResultCache or memo_store a tk.MemoStore, results are
+    looked up in and added to them.
+    """
+    result_columns = ["phrase_type_string", "phrase_type", "phrase_validation", output_column]
+    memo = {}
+    for index, rowdict in rows:
         data_item = rowdict[target_column]
+        cached = cache.get(data_item) if cache is not None else None
         if rowdict["word_validation"] == "fail" or rowdict["word_validation"] == "stopped":
             rowdict["phrase_type_string"] = "stopped"
             rowdict["phrase_type"] = "stopped"
             rowdict["phrase_validation"] = "stopped"
             rowdict[output_column] = data_item
+        elif cached is not None:
+            rowdict.update(cached[0])
+        elif dedup and data_item in memo:
+            rowdict.update(memo[data_item])
         else:
-            phrase_dict = build_phrase_dict(data_item, separator)
-            cat_string = make_categorization_string(phrase_dict)
-            rowdict["phrase_type_string"] = cat_string
-            rearrange_phrase(cat_string, rowdict, phrase_dict, output_column, style)
-            if rowdict["phrase_validation"] == "fail":
-                phrase_type = rowdict["phrase_type"]
-                rowdict[output_column] = f"! Invalid phrase type: {phrase_type} !"
-    if style == "data_loc":
-        dls.validity_score(data_dict)
-    output_path = os.path.join(style, "output_files", f"p_norm_{style}.tsv")
-    dict2TSV(data_dict, output_path)
+            stored = memo_store.get(data_item) if memo_store is not None else None
+            if stored is not None:
+                results, review_log, words, check = stored
+                rowdict.update(results)
+            else:
+                phrase_dict = build_phrase_dict(data_item, separator, category_map)
+                cat_string = make_categorization_string(phrase_dict)
+                rowdict["phrase_type_string"] = cat_string
+                rearrange_phrase(cat_string, rowdict, phrase_dict, output_column, style,
+                                 phrase_types)
+                if rowdict["phrase_validation"] == "fail":
+                    phrase_type = rowdict["phrase_type"]
+                    rowdict[output_column] = f"! Invalid phrase type: {phrase_type} !"
+                results = {column: rowdict[column] for column in result_columns}
+                if cache is not None or memo_store is not None:
+                    words = [word_dict["word"] for word_dict in phrase_dict.values()]
+                    categories = [word_dict["category"] for word_dict in phrase_dict.values()]
+                    check = (cat_string, categories,
+                             phrase_types.matched_row(cat_string, categories))
+                if memo_store is not None:
+                    memo_store.put(data_item, results, [], words, check)
+            if cache is not None:
+                cache.put(data_item, results, [], words, check)
+            elif dedup:
+                memo[data_item] = results
+        yield index, rowdict
 
 
-if __name__ == "__main__":
-    style = sys.argv[1]
-    original_column = sys.argv[2]
-    input_file = os.path.join(style, "output_files", f"w_norm_{style}.tsv")
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("style",
+                        help="Data style, e.g., age or data_loc")
+    parser.add_argument("column",
+                        help="Name of the starting column, e.g., h_age")
+    tk.add_stage_arguments(parser)
+    args = parser.parse_args()
+    style = args.style
+    input_file = resolve_path(os.path.join(style, "output_files", f"w_norm_{style}.tsv"))
     word_review_file = os.path.join(style, "output_files", "word_review.tsv")
     word_reference_file = os.path.join(style, "output_files", "word_reference.tsv")
     type_file = os.path.join(style, "output_files", f"{style}_phrase_types.tsv")
-    if not os.path.isfile(type_file):
-        create_phrase_type_sheet(type_file)
-    word_review_dict = TSV2dict(word_review_file)
-    word_reference_dict = TSV2dict(word_reference_file)
-    type_dict = TSV2dict(type_file)
-    normalize_phrase(style, input_file, original_column)
+    cache_dir = os.path.join(style, "output_files", "cache")
+    normalize_phrase(style, input_file, args.column, type_file, word_review_file,
+                     word_reference_file, args.dedup, args.compress, args.columnar,
+                     cache_dir if args.incremental else None,
+                     None if args.no_cache else cache_dir, args.memo)
+
+
+if __name__ == "__main__":
+    main()
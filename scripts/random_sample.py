@@ -2,7 +2,7 @@ import argparse
 import os
 import random
 import re
-from converter import dict2TSV, TSV2dict
+from converter import LazyTSV, dict2TSV, TSV2dict, resolve_path
 
 
 def get_error_count(line_count):
@@ -15,11 +15,10 @@ def get_error_count(line_count):
     return errors
 
 
-def get_selectable_data(data, style, target_column):
+def select_row(rowdict, style, target_column):
     """
-    Get a dict of index-row pairs for the random line selector to pick from.
+    Return the sample line for a row, or None if the row can't be picked.
     """
-    selectable_data = {}
     if target_column == "location":
         output_column = "clean_output"
     else:
@@ -29,21 +28,30 @@ def get_selectable_data(data, style, target_column):
         target_column: f"input_{style}",
         output_column: f"output_{style}"
     }
-    for index, rowdict in data.items():
-        selectable_line = False
-        if rowdict["phrase_validation"] == "pass":
-            selectable_line = True
-        if "split_phrase_count" in rowdict.keys():
-            if rowdict["split_phrase_count"] == "":
-                selectable_line = False
-            if rowdict["phrase_validity_rate"] != "1.0":
-                selectable_line = False
-        if rowdict["phrase_type"] == "url":
+    selectable_line = False
+    if rowdict["phrase_validation"] == "pass":
+        selectable_line = True
+    if "split_phrase_count" in rowdict.keys():
+        if rowdict["split_phrase_count"] == "":
+            selectable_line = False
+        if rowdict["phrase_validity_rate"] != "1.0":
             selectable_line = False
-        if selectable_line:
-            selectable_data[index] = {}
-            for col, pseudonym in selected_columns.items():
-                selectable_data[index][pseudonym] = rowdict[col]
+    if rowdict["phrase_type"] == "url":
+        selectable_line = False
+    if not selectable_line:
+        return None
+    return {pseudonym: rowdict[col] for col, pseudonym in selected_columns.items()}
+
+
+def get_selectable_data(data, style, target_column):
+    """
+    Get a dict of index-row pairs for the random line selector to pick from.
+    """
+    selectable_data = {}
+    for index, rowdict in data.items():
+        selected_line = select_row(rowdict, style, target_column)
+        if selected_line is not None:
+            selectable_data[index] = selected_line
     return selectable_data
 
 
@@ -60,6 +68,40 @@ def pick_random_sample(selectable_data, line_count):
     return selected_data
 
 
+def iter_random_positions(count):
+    """
+    Yield each number from 0 to count - 1 once, in random order.
+    """
+    seen = set()
+    # Draw at random until half are used, then shuffle whatever is left
+    while len(seen) < count // 2:
+        position = random.randrange(count)
+        if position not in seen:
+            seen.add(position)
+            yield position
+    remaining = [position for position in range(count) if position not in seen]
+    random.shuffle(remaining)
+    yield from remaining
+
+
+def pick_lazy_sample(table, style, target_column, line_count):
+    """
+    Select desired number of lines randomly from a LazyTSV, reading rows at
+    random until enough of them can be picked rather than reading them all.
+    """
+    picked = {}
+    for position in iter_random_positions(len(table)):
+        if len(picked) == line_count:
+            break
+        index, rowdict = table.row(position)
+        selected_line = select_row(rowdict, style, target_column)
+        if selected_line is not None:
+            picked[position] = (index, selected_line)
+    if len(picked) < line_count:
+        raise ValueError(f"Only {len(picked)} lines can be picked, fewer than {line_count}.")
+    return dict(picked[position] for position in sorted(picked))
+
+
 def generate_error(data_item):
     """
     Create an intentional error in a data item string.
@@ -132,9 +174,14 @@ def main():
         infile = os.path.join(style, "output_files", f"p_norm_{style}.tsv")
     outfile = os.path.join(style, "analysis", f"random_sample_{style}.tsv")
     outdata = os.path.join(style, "analysis", f"error_key_{style}.tsv")
-    data = TSV2dict(infile)
-    selectable_data = get_selectable_data(data, style, target_column)
-    selected_data = pick_random_sample(selectable_data, line_count)
+    infile = resolve_path(infile)
+    if infile.endswith(".tsv"):
+        with LazyTSV(infile) as table:
+            selected_data = pick_lazy_sample(table, style, target_column, line_count)
+    else:
+        data = TSV2dict(infile)
+        selectable_data = get_selectable_data(data, style, target_column)
+        selected_data = pick_random_sample(selectable_data, line_count)
     errored_data, error_info = insert_errors(selected_data, error_count, style)
     print(f"Generated random sample with length {line_count} and {error_count} intentional errors.")
     dict2TSV(error_info, outdata)
@@ -1,6 +1,7 @@
 import argparse
+import math
 import os
-from converter import TSV2dict, dict2TSV
+from converter import TSV2table, dict2TSV, resolve_path
 from statistics import mean, median, stdev
 
 
@@ -18,6 +19,48 @@ def numberize(numstring):
             return int(numstring)
 
 
+def get_weight(rowdict, weight_column):
+    """
+    Return the number of occurrences a row stands for.
+    """
+    if weight_column is None:
+        return 1
+    return int(rowdict[weight_column])
+
+
+def weighted_mean(values, weights):
+    """
+    Return the mean of values with each repeated as many times as its weight.
+    """
+    return sum(value * weight for value, weight in zip(values, weights)) / sum(weights)
+
+
+def weighted_median(values, weights):
+    """
+    Return the median of values with each repeated as many times as its weight.
+    """
+    pairs = sorted(zip(values, weights))
+    total = sum(weights)
+    targets = [total // 2] if total % 2 == 1 else [total // 2 - 1, total // 2]
+    found = []
+    position = 0
+    for value, weight in pairs:
+        for target in targets:
+            if position <= target < position + weight:
+                found.append(value)
+        position += weight
+    return sum(found) / len(found) if len(found) == 2 else found[0]
+
+
+def weighted_stdev(values, weights):
+    """
+    Return the sample standard deviation of values repeated by their weights.
+    """
+    center = weighted_mean(values, weights)
+    squares = sum(weight * (value - center) ** 2 for value, weight in zip(values, weights))
+    return math.sqrt(squares / (sum(weights) - 1))
+
+
 def add_metric(metrics, name, value):
     if len(metrics.keys()) == 0:
         new_index = 0
@@ -31,7 +74,13 @@ def add_metric(metrics, name, value):
     }
 
 
-def get_basic_metrics(style, data, target_column, metrics):
+def get_basic_metrics(style, data, target_column, metrics, weight_column=None):
+    """
+    Add validation pass rates and distance score statistics to metrics.
+
+    If weight_column is given, each row counts as many times as its value in
+    that column.
+    """
     cols = {
         "char_validation": "Character stage validation pass rate",
         "char_distance_score": "Character stage Levenshtein distance score",
@@ -43,11 +92,12 @@ def get_basic_metrics(style, data, target_column, metrics):
         tracker = {}
         for index, rowdict in data.items():
             if rowdict[col] != "":
+                weight = get_weight(rowdict, weight_column)
                 if rowdict[col] not in tracker.keys():
-                    tracker[rowdict[col]] = 1
+                    tracker[rowdict[col]] = weight
                 else:
                     count = tracker[rowdict[col]]
-                    count += 1
+                    count += weight
                     tracker[rowdict[col]] = count
         total = 0
         for value, count in tracker.items():
@@ -60,12 +110,19 @@ def get_basic_metrics(style, data, target_column, metrics):
         "word_distance_score",
     ]:
         tracker = []
+        weights = []
         for index, rowdict in data.items():
             if rowdict[col] != "":
                 tracker.append(numberize(rowdict[col]))
-        col_median = median(tracker)
-        col_mean = round(mean(tracker), 4)
-        col_stdev = round(stdev(tracker), 4)
+                weights.append(get_weight(rowdict, weight_column))
+        if weight_column is None:
+            col_median = median(tracker)
+            col_mean = round(mean(tracker), 4)
+            col_stdev = round(stdev(tracker), 4)
+        else:
+            col_median = weighted_median(tracker, weights)
+            col_mean = round(weighted_mean(tracker, weights), 4)
+            col_stdev = round(weighted_stdev(tracker, weights), 4)
         add_metric(metrics, f"{cols[col]} median", col_median)
         add_metric(metrics, f"{cols[col]} mean", col_mean)
         add_metric(metrics, f"{cols[col]} standard deviation", col_stdev)
@@ -79,6 +136,8 @@ def main():
                         help="Target filename, if not p_norm_<style>.tsv")
     parser.add_argument("--column", "-c",
                         help="Name of the starting column, e.g., h_age")
+    parser.add_argument("--weights", "-w",
+                        help="Column holding the number of occurrences each row stands for")
     args = parser.parse_args()
     style = args.style
     path = os.path.join(style, "output_files", f"p_norm_{style}.tsv")
@@ -86,9 +145,9 @@ def main():
         path = os.path.join(style, "output_files", args.filename)
     output = os.path.join(style, "output_files", f"{style}_basic_metrics.tsv")
     target_column = args.column
-    data = TSV2dict(path)
+    data = TSV2table(resolve_path(path))
     metrics = {}
-    get_basic_metrics(style, data, target_column, metrics)
+    get_basic_metrics(style, data, target_column, metrics, args.weights)
     dict2TSV(metrics, output)
 
 
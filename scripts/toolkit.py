@@ -1,5 +1,565 @@
+import collections
+import hashlib
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
 import re
+import shutil
+import sqlite3
+import sys
+import time
 import editdistance as ed
+from converter import TSV2dict, dict2TSV
+
+
+class IndexAllocator:
+    """
+    Hands out the lowest index not yet used as a key in a dict.
+
+    Gaps left by deleted rows are kept on a heap so the lowest one can be
+    reused without rescanning every key.
+    """
+
+    def __init__(self, dict_with_index):
+        used = set(int(i) for i in dict_with_index.keys())
+        self.top = max(used) + 1 if len(used) != 0 else 0
+        self.free = [i for i in range(self.top) if i not in used]
+
+    def allocate(self):
+        """
+        Return the lowest free index and mark it as used.
+        """
+        if len(self.free) != 0:
+            return heapq.heappop(self.free)
+        index = self.top
+        self.top += 1
+        return index
+
+    def release(self, index):
+        """
+        Mark index as free again.
+        """
+        heapq.heappush(self.free, int(index))
+
+
+class RuleIndex:
+    """
+    Hash index of the items logged in a reference and review dict.
+
+    Maps each unknown item to the indices of the rows it appears in so that
+    lookups do not have to scan every row. Reference rows take precedence over
+    review rows and earlier rows over later ones, the same as a linear lookup.
+    Also holds an IndexAllocator for each dict so new rows can be numbered.
+    """
+
+    def __init__(self, review_dict, reference_dict, mode):
+        if mode == "char":
+            mode = "character"
+        self.column = f"unknown_{mode}"
+        self.locations = {"reference": {}, "review": {}}
+        self.allocators = {
+            "reference": IndexAllocator(reference_dict),
+            "review": IndexAllocator(review_dict)
+        }
+        for index, rowdict in reference_dict.items():
+            self.add("reference", rowdict[self.column], index)
+        for index, rowdict in review_dict.items():
+            self.add("review", rowdict[self.column], index)
+
+    def add(self, source, item, index):
+        """
+        Record that item is logged at index in source.
+        """
+        self.locations[source].setdefault(item, []).append(index)
+
+    def remove(self, source, item, index):
+        """
+        Forget that item is logged at index in source.
+        """
+        indices = self.locations[source].get(item, [])
+        if index in indices:
+            indices.remove(index)
+            if len(indices) == 0:
+                del self.locations[source][item]
+
+    def lookup(self, item):
+        """
+        Return the source and index of the first row logging item.
+        """
+        for source in ["reference", "review"]:
+            indices = self.locations[source].get(item)
+            if indices:
+                return source, indices[0]
+        return None, None
+
+
+class RuleProgram:
+    """
+    Replace and remove actions from a reference dict, compiled once per run.
+
+    Without delimiters, every action is folded into one alternation that is
+    applied to a data item in a single pass. With delimiters, the data item is
+    split on the delimiters once and each word is looked up in a hash map of
+    replacements, which matches what the delimiter-bounded regex of
+    take_action would replace. Items that themselves contain a delimiter fall
+    back to that regex, compiled the first time it is needed and reused.
+    Earlier reference rows take precedence over later ones, like lookup.
+    """
+
+    def __init__(self, reference_dict, mode, delimiters):
+        if mode == "char":
+            mode = "character"
+        self.delimiters = delimiters
+        self.replacements = {}
+        self.patterns = {}
+        seen = set()
+        for index, rowdict in reference_dict.items():
+            item = rowdict[f"unknown_{mode}"]
+            if item in seen:
+                continue
+            seen.add(item)
+            if rowdict["replace_with"] != "":
+                self.replacements[item] = rowdict["replace_with"]
+            elif rowdict["remove"] != "":
+                self.replacements[item] = ""
+        if delimiters is None:
+            self.single_pass = self.is_order_independent()
+            items = sorted(self.replacements.keys(), key=len, reverse=True)
+            if self.single_pass and len(items) != 0:
+                self.regex = re.compile(r"|".join(re.escape(item) for item in items))
+            else:
+                self.regex = None
+        else:
+            self.single_pass = True
+            self.delimiter_regex = r"|".join(re.escape(delimiter) for delimiter in delimiters)
+            self.splitter = re.compile(fr"({self.delimiter_regex})")
+            self.scannable = set(item for item in self.replacements.keys()
+                                 if not self.splitter.search(item))
+
+    def is_order_independent(self):
+        """
+        Check that applying the actions in one pass gives the sequential result.
+
+        This holds unless one item contains another or a replacement
+        introduces an item that would then be replaced in turn.
+        """
+        for item in self.replacements.keys():
+            for other in self.replacements.keys():
+                if item != other and other in item:
+                    return False
+                if other in self.replacements[item]:
+                    return False
+        return True
+
+    def compile(self, item):
+        """
+        Return the compiled regex and replacement template for item.
+        """
+        if item not in self.patterns:
+            replacement = self.replacements[item]
+            if self.delimiters is None:
+                target_regex = re.escape(item)
+                template = replacement
+            else:
+                delimiters = self.delimiter_regex
+                target_regex = fr"(^|{delimiters}){re.escape(item)}({delimiters}|$)"
+                template = fr"\g<1>{replacement}\g<2>"
+            self.patterns[item] = re.compile(target_regex), template
+        return self.patterns[item]
+
+    def scan_words(self, targets, data_item):
+        """
+        Replace every delimiter-bounded occurrence of targets in one scan.
+        """
+        parts = self.splitter.split(data_item)
+        last_replaced = {}
+        for position in range(0, len(parts), 2):
+            word = parts[position]
+            if word in targets:
+                # The regex consumes the delimiter after a match, so an
+                # occurrence directly after a replaced one is left as is.
+                if last_replaced.get(word) == position - 2:
+                    continue
+                parts[position] = self.replacements[word]
+                last_replaced[word] = position
+        return "".join(parts)
+
+    def apply(self, items, data_item):
+        """
+        Apply the actions for items, all found in the reference dict, to data_item.
+
+        Whitespace is normalized once per item, as take_action callers do.
+        """
+        targets = set(item for item in items if item in self.replacements)
+        if self.delimiters is not None:
+            scanned = targets & self.scannable
+            if len(scanned) != 0:
+                data_item = self.scan_words(scanned, data_item)
+            targets -= scanned
+        if self.delimiters is None and self.single_pass and len(targets) != 0:
+
+            def replace(match):
+                if match.group() in targets:
+                    return match.expand(self.replacements[match.group()])
+                return match.group()
+            data_item = self.regex.sub(replace, data_item)
+            # normalize_whitespace isn't idempotent, e.g., "a ." -> "a " -> "a", so it
+            # runs once per item, as when each item's action is applied in turn
+            for _ in items:
+                data_item = normalize_whitespace(data_item)
+        else:
+            for item in items:
+                if item in targets:
+                    regex, template = self.compile(item)
+                    data_item = regex.sub(template, data_item)
+                data_item = normalize_whitespace(data_item)
+        return data_item
+
+
+class ResultCache:
+    """
+    A stage's results for each distinct value it normalized, kept on disk so
+    that a rerun only normalizes values whose rules have changed.
+
+    Each entry holds a value's result columns, the review events it logged,
+    the items (characters or words) whose rules it depended on, and an
+    optional check for the stage to test later. refresh compares the rules
+    of every item with those of the last run and drops the entries that
+    depend on a changed one. A cache saved with different settings, e.g., for
+    another column or by changed scripts, is ignored. The file is JSON, so
+    loading one from shared storage can't run code, unlike a pickle.
+    """
+
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.entries = {}
+        self.rules = {}
+        self.used = set()
+        self.saved_stat = None
+        if os.path.isfile(path):
+            try:
+                with open(path, encoding="utf-8") as infile:
+                    saved = json.load(infile)
+            except (OSError, ValueError):
+                saved = None
+            if type(saved) is dict and saved.get("settings") == list(settings):
+                self.entries = {value: decode_entry(entry)
+                                for value, entry in saved["entries"].items()}
+                self.rules = {item: as_tuples(rule) for item, rule in saved["rules"].items()}
+
+    def refresh(self, rules, is_stale=None):
+        """
+        Drop the entries depending on an item whose rule differs from the last
+        run, or whose check is_stale returns True for.
+
+        rules maps each item that has a rule to a summary of that rule.
+        Returns the set of items whose rules changed.
+        """
+        changed = set(item for item in self.rules.keys() | rules.keys()
+                      if self.rules.get(item) != rules.get(item))
+        for value, (results, review_log, items, check) in list(self.entries.items()):
+            if not changed.isdisjoint(items) or (is_stale is not None and is_stale(check)):
+                del self.entries[value]
+        self.rules = rules
+        return changed
+
+    def get(self, value):
+        """
+        Return the result columns and review events saved for value, or None.
+        """
+        entry = self.entries.get(value)
+        if entry is None:
+            return None
+        self.used.add(value)
+        return entry[0], entry[1]
+
+    def put(self, value, results, review_log, items, check=None):
+        """
+        Save the results of value, which depended on the rules for items.
+        """
+        self.entries[value] = (results, review_log, frozenset(items), check)
+        self.used.add(value)
+
+    def save(self):
+        """
+        Write the entries for the values seen in this run to the cache file.
+        """
+        entries = {value: entry for value, entry in self.entries.items() if value in self.used}
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temporary_path = f"{self.path}.{os.getpid()}"
+        with open(temporary_path, "w", encoding="utf-8") as outfile:
+            json.dump({"settings": self.settings,
+                       "entries": {value: encode_entry(entry) for value, entry in entries.items()},
+                       "rules": self.rules}, outfile)
+        os.replace(temporary_path, self.path)
+        self.entries = entries
+        self.saved_stat = file_stat(self.path)
+        saved_result_caches[self.path] = self
+
+
+def encode_entry(entry):
+    """
+    Return a ResultCache or MemoStore entry as lists that can be saved as JSON.
+    """
+    results, review_log, items, check = entry
+    return [results, review_log, sorted(items), check]
+
+
+def decode_entry(saved):
+    """
+    Return the entry encode_entry saved, with its review events and check
+    turned back into tuples and its items into a frozenset.
+    """
+    results, review_log, items, check = saved
+    return results, [tuple(event) for event in review_log], frozenset(items), as_tuples(check)
+
+
+def as_tuples(value):
+    """
+    Return value with the lists that JSON made of its tuples, at any depth,
+    turned back into tuples.
+    """
+    if type(value) is list:
+        return tuple(as_tuples(part) for part in value)
+    return value
+
+
+# ResultCaches saved by this process, by path, so that a long-lived process,
+# e.g., adp.py watch, doesn't load the files it wrote itself again
+saved_result_caches = {}
+
+
+def file_stat(path):
+    """
+    Return the modification time and size of the file at path, or None if
+    there is no such file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def open_result_cache(path, settings):
+    """
+    Return a ResultCache for path and settings, reusing the one this process
+    last saved there if the file hasn't changed since.
+    """
+    cache = saved_result_caches.get(path)
+    if cache is not None and cache.settings == settings and cache.saved_stat is not None \
+            and cache.saved_stat == file_stat(path):
+        cache.used = set()
+        return cache
+    return ResultCache(path, settings)
+
+
+def rule_summaries(reference_dict, rule_index, allowed_items):
+    """
+    Summarize the rule each item logged in reference_dict gets, for
+    ResultCache.refresh. The first row logging an item holds its rule.
+    """
+    summaries = {}
+    for item, indices in rule_index.locations["reference"].items():
+        rowdict = reference_dict[indices[0]]
+        summaries[item] = (rowdict["replace_with"], rowdict["remove"], rowdict["invalidate"],
+                           rowdict["allow"], item in allowed_items)
+    return summaries
+
+
+def source_digest(*modules):
+    """
+    Return a hash of the source files of modules, so results saved by other
+    versions of the scripts can be told apart.
+    """
+    digest = hashlib.sha256()
+    for module in modules:
+        with open(module.__file__, "rb") as infile:
+            digest.update(infile.read())
+    return digest.hexdigest()
+
+
+def rules_version(settings, rules):
+    """
+    Return a hash of a stage's settings and the rules it runs with, where
+    rules maps each item to a summary of its rule, for a MemoStore.
+    """
+    return hashlib.sha256(repr((settings, sorted(rules.items()))).encode("utf-8")).hexdigest()
+
+
+class MemoStore:
+    """
+    A stage's results for each distinct value it normalized, kept in an
+    SQLite database that can be shared by styles, stages and runs, so that
+    each value is normalized only once for a given set of rules.
+
+    Entries are keyed by style, stage, value and version, a hash of the
+    stage's settings and all of its rules, so a change to any rule starts
+    over for that stage. Each entry holds the same as a ResultCache entry,
+    saved as JSON. New entries are written in batches and on save.
+    """
+
+    batch_size = 10000
+
+    def __init__(self, path, style, stage, version):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS memo (style TEXT, stage TEXT, "
+                                "version TEXT, value TEXT, entry TEXT, "
+                                "PRIMARY KEY (style, stage, version, value))")
+        self.key = (style, stage, version)
+        self.pending = []
+
+    def get(self, value):
+        """
+        Return the result columns, review events, items and check saved for
+        value, or None.
+        """
+        row = self.connection.execute("SELECT entry FROM memo WHERE style = ? AND stage = ? "
+                                      "AND version = ? AND value = ?",
+                                      (*self.key, value)).fetchone()
+        return None if row is None else decode_entry(json.loads(row[0]))
+
+    def put(self, value, results, review_log, items, check=None):
+        """
+        Save the results of value, which depended on the rules for items.
+        """
+        entry = encode_entry((results, review_log, items, check))
+        self.pending.append((*self.key, value, json.dumps(entry)))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the entries put since the last flush to the database.
+        """
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?)",
+                                        self.pending)
+        self.pending = []
+
+    def save(self):
+        """
+        Write the remaining entries and close the database.
+        """
+        self.flush()
+        self.connection.close()
+
+
+def file_digest(path):
+    """
+    Return a hash of the contents of the file at path, or "missing" if there
+    is no such file.
+    """
+    if not os.path.isfile(path):
+        return "missing"
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Size the stage cache is pruned back to after each run is stored
+default_stage_cache_bytes = 1 << 30
+
+
+class StageCache:
+    """
+    Output files of earlier runs, stored under a hash of everything that went
+    into them: the contents of the data file and rule sheets read, the
+    output paths, the settings and the source of the scripts.
+
+    A run whose hash matches a stored one copies that run's outputs into
+    place instead of normalizing anything. Runs are stored in the stages
+    folder of cache_dir, which is pruned back to max_bytes after each run is
+    stored, dropping the least recently used first.
+    """
+
+    def __init__(self, cache_dir, max_bytes=default_stage_cache_bytes):
+        self.root = os.path.join(cache_dir, "stages")
+        self.max_bytes = max_bytes
+
+    def key(self, stage, inputs, outputs, settings, modules=()):
+        """
+        Return the hash identifying a run of stage that reads the files in
+        inputs and writes those in outputs. modules are the scripts it runs,
+        along with the toolkit and converter.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr((stage, list(outputs), settings)).encode("utf-8"))
+        modules = [sys.modules[__name__], sys.modules["converter"], *modules]
+        digest.update(source_digest(*modules).encode("utf-8"))
+        for path in inputs:
+            digest.update(file_digest(path).encode("utf-8"))
+        return digest.hexdigest()
+
+    def restore(self, key, outputs):
+        """
+        Copy the outputs of the run stored under key into place.
+        Returns False if no such run is stored.
+        """
+        entry = os.path.join(self.root, key)
+        if not os.path.isdir(entry):
+            return False
+        for i, path in enumerate(outputs):
+            stored = os.path.join(entry, str(i))
+            if os.path.isfile(stored):
+                shutil.copyfile(stored, path)
+                print(f"{path} restored from an earlier run with the same inputs.")
+        os.utime(entry)
+        return True
+
+    def store(self, key, outputs):
+        """
+        Save copies of the outputs of a run under key.
+        """
+        entry = os.path.join(self.root, key)
+        temporary_entry = f"{entry}.{os.getpid()}"
+        os.makedirs(temporary_entry, exist_ok=True)
+        for i, path in enumerate(outputs):
+            if os.path.isfile(path):
+                shutil.copyfile(path, os.path.join(temporary_entry, str(i)))
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        os.rename(temporary_entry, entry)
+        prune_stage_cache(self.root, self.max_bytes)
+
+
+def prune_stage_cache(root, max_bytes=None, max_age=None):
+    """
+    Delete the runs stored in a StageCache folder that were last used more
+    than max_age seconds ago, then the least recently used ones until the
+    rest take up at most max_bytes.
+
+    Returns the number of runs deleted and the bytes freed.
+    """
+    if not os.path.isdir(root):
+        return 0, 0
+    entries = []
+    for name in os.listdir(root):
+        entry = os.path.join(root, name)
+        # Skip runs still being stored, which have a process id suffix
+        if os.path.isdir(entry) and "." not in name:
+            size = sum(os.path.getsize(os.path.join(entry, stored)) for stored in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+    entries.sort()
+    total = sum(size for used, size, entry in entries)
+    deleted, freed = 0, 0
+    now = time.time()
+    for used, size, entry in entries:
+        too_old = max_age is not None and now - used > max_age
+        too_big = max_bytes is not None and total > max_bytes
+        if not too_old and not too_big:
+            continue
+        shutil.rmtree(entry)
+        total -= size
+        deleted += 1
+        freed += size
+    return deleted, freed
 
 
 def normalize_whitespace(string):
@@ -41,6 +601,37 @@ def check_action(rowdict):
         return None
 
 
+def load_sheets(review_file, reference_file):
+    """
+    Read review and reference dicts from their files, or start empty ones.
+    """
+    if os.path.isfile(review_file):
+        review_dict = TSV2dict(review_file)
+    else:
+        review_dict = {}
+    if os.path.isfile(reference_file):
+        reference_dict = TSV2dict(reference_file)
+    else:
+        reference_dict = {}
+    return review_dict, reference_dict
+
+
+def write_sheets(review_dict, review_file, reference_dict, reference_file):
+    """
+    Write review and reference dicts to their files if they have any rows.
+    Returns the file_stat of each file written, by path, taken just after it
+    was written.
+    """
+    written = {}
+    if len(review_dict.keys()) != 0:
+        dict2TSV(review_dict, review_file)
+        written[review_file] = file_stat(review_file)
+    if len(reference_dict.keys()) != 0:
+        dict2TSV(reference_dict, reference_file)
+        written[reference_file] = file_stat(reference_file)
+    return written
+
+
 def clean_occurrences(review_dict):
     """
     Reset occurrences in review_dict to 1 to recoun each time script is rerun.
@@ -62,9 +653,11 @@ def evaluate_ld(rowdict, stage, target_column, output_column):
     return rowdict
 
 
-def create_new_review_entry(review_dict, style, stage, id, invalid_item, data_item):
+def create_new_review_entry(review_dict, style, stage, id, invalid_item, data_item, weight=1):
     """
     Create a new line item in the review sheet.
+
+    weight is the number of occurrences the data item stands for.
     """
     entry_dict = {}
     if stage == "char":
@@ -78,7 +671,7 @@ def create_new_review_entry(review_dict, style, stage, id, invalid_item, data_it
         else:
             entry_dict["pdb_plausible?"] = "N"
     entry_dict["context"] = f"""'{data_item}'"""
-    entry_dict["occurrences"] = 1
+    entry_dict["occurrences"] = weight
     if stage == "word":
         entry_dict["category"] = ""
     entry_dict["replace_with"] = ""
@@ -88,9 +681,11 @@ def create_new_review_entry(review_dict, style, stage, id, invalid_item, data_it
     return entry_dict
 
 
-def add_to_review_entry(review_dict, location, data_item):
+def add_to_review_entry(review_dict, location, data_item, weight=1):
     """
     Update review dict line item with additional occurrences/context.
+
+    weight is the number of occurrences the data item stands for.
     """
     if data_item not in review_dict[location]["context"]:
         if len(review_dict[location]["context"]) < 300:
@@ -98,7 +693,7 @@ def add_to_review_entry(review_dict, location, data_item):
             context_string += f""", '{data_item}'"""
             review_dict[location]["context"] = context_string
     occurrences = int(review_dict[location]["occurrences"])
-    occurrences += 1
+    occurrences += weight
     review_dict[location]["occurrences"] = occurrences
     return review_dict
 
@@ -110,9 +705,43 @@ def handle_invalid_items(style,
                          stage,
                          data_item,
                          allowed_items,
-                         delimiters):
+                         delimiters,
+                         rule_index=None,
+                         program=None,
+                         review_log=None,
+                         weight=1):
+    """
+    Apply reference actions for invalid_items and log the rest for review.
+
+    If a compiled program is given, the reference actions for consecutive
+    items are applied together with it. Each item logged for review gets the
+    data item as corrected by the items before it, as without a program.
+    If review_log is a list, each item logged for review is appended to it
+    along with its context so the logging can be replayed with replay_review_log.
+    weight is the number of occurrences data_item stands for, e.g., when the
+    data is a table of distinct values and their counts.
+    """
+    if program is not None:
+        reference_items = []
+        for item in invalid_items:
+            source, location = lookup(item, review_dict, reference_dict, stage, rule_index)
+            if source == "reference":
+                reference_items.append(item)
+                if reference_dict[location]["allow"] != "":
+                    allowed_items.add(item)
+                continue
+            if len(reference_items) != 0:
+                data_item = program.apply(reference_items, data_item)
+                reference_items = []
+            review_dict = log_for_review(style, item, review_dict, stage, data_item,
+                                         source, location, rule_index, weight)
+            if review_log is not None:
+                review_log.append((item, data_item))
+        if len(reference_items) != 0:
+            data_item = program.apply(reference_items, data_item)
+        return review_dict, reference_dict, data_item, allowed_items
     for item in invalid_items:
-        source, location = lookup(item, review_dict, reference_dict, stage)
+        source, location = lookup(item, review_dict, reference_dict, stage, rule_index)
         if source == "reference":
             data_item = take_action(
                 reference_dict,
@@ -124,19 +753,233 @@ def handle_invalid_items(style,
             data_item = normalize_whitespace(data_item)
             if reference_dict[location]["allow"] != "":
                 allowed_items.add(item)
-        elif source == "review":
-            review_dict = add_to_review_entry(review_dict, location, data_item)
         else:
-            id = next_index(review_dict)
-            review_line = create_new_review_entry(review_dict, style, stage, id, item, data_item)
-            review_dict[id] = review_line
+            review_dict = log_for_review(style, item, review_dict, stage, data_item,
+                                         source, location, rule_index, weight)
+            if review_log is not None:
+                review_log.append((item, data_item))
     return review_dict, reference_dict, data_item, allowed_items
 
 
-def next_index(dict_with_index):
+def log_for_review(style, item, review_dict, stage, data_item, source, location, rule_index,
+                   weight=1):
+    """
+    Count an occurrence of an item already under review or add a new entry.
+    """
+    if source == "review":
+        review_dict = add_to_review_entry(review_dict, location, data_item, weight)
+    else:
+        if rule_index is not None:
+            id = next_index(review_dict, rule_index.allocators["review"])
+        else:
+            id = next_index(review_dict)
+        review_line = create_new_review_entry(review_dict, style, stage, id, item, data_item,
+                                              weight)
+        review_dict[id] = review_line
+        if rule_index is not None:
+            rule_index.add("review", item, id)
+    return review_dict
+
+
+def replay_review_log(style, review_log, review_dict, reference_dict, stage, rule_index=None,
+                      weight=1):
+    """
+    Log the items in review_log for review again, as for a repeated data item.
+    """
+    for item, data_item in review_log:
+        source, location = lookup(item, review_dict, reference_dict, stage, rule_index)
+        review_dict = log_for_review(style, item, review_dict, stage, data_item,
+                                     source, location, rule_index, weight)
+    return review_dict
+
+
+worker_stage = None
+
+
+def init_worker(stage_class, stage_args):
+    """
+    Build the stage a worker process runs its chunks of rows through.
+    """
+    global worker_stage
+    worker_stage = stage_class(*stage_args)
+
+
+def process_chunk(chunk):
+    return worker_stage.process_chunk(chunk)
+
+
+def iter_sharded(rows, stage_class, stage_args, workers, chunk_size=256):
+    """
+    Run rows through stage_class(*stage_args).process_chunk in a pool of
+    worker processes and yield the results in the order of rows.
+
+    Rows are sent out in chunks of chunk_size, and only a few chunks per worker
+    are in flight at a time, so rows can be a stream of any length.
+    """
+    rows = iter(rows)
+    chunks = iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+    pending = collections.deque()
+    with multiprocessing.Pool(workers, init_worker, (stage_class, stage_args)) as pool:
+        for chunk in chunks:
+            # The pool pickles chunks in another thread, so rows that read
+            # through to a Table being written here are copied first
+            chunk = [(index, dict(rowdict)) for index, rowdict in chunk]
+            pending.append(pool.apply_async(process_chunk, (chunk,)))
+            if len(pending) > workers * 2:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
+
+
+class RuleStage:
+    """
+    The parts of CharStage and WordStage that keep and reuse results and log
+    review events, for the stage named stage, "char" or "word".
+
+    A subclass sets rule_index, review_dict, reference_dict and result_columns,
+    calls open_results if results are cached, and defines process.
+    """
+
+    def __init__(self, stage, style, dedup=False, weight_column=None):
+        self.stage = stage
+        self.style = style
+        self.dedup = dedup
+        self.weight_column = weight_column
+        self.memo = {}
+        self.cache = None
+        self.memo_store = None
+
+    def open_results(self, column, settings, rules, cache_dir=None, memo_path=None):
+        """
+        Keep results in a ResultCache in cache_dir and a MemoStore at memo_path,
+        if given, for the stage's settings and rules.
+        """
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, f"{self.stage}_{column}.json")
+            self.cache = open_result_cache(cache_path, settings)
+            self.cache.refresh(rules)
+        if memo_path is not None:
+            self.memo_store = MemoStore(memo_path, self.style, self.stage,
+                                        rules_version(settings, rules))
+
+    def weight(self, rowdict):
+        """
+        Return the number of occurrences rowdict stands for.
+        """
+        return int(rowdict[self.weight_column]) if self.weight_column else 1
+
+    def replay(self, review_log, weight=1):
+        """
+        Log the review events of a row normalized elsewhere, e.g., in a worker.
+        """
+        self.review_dict = replay_review_log(self.style, review_log, self.review_dict,
+                                             self.reference_dict, self.stage, self.rule_index,
+                                             weight)
+
+    def recall(self, data_item):
+        """
+        Return the results and review events kept for data_item, or None.
+        """
+        recalled = None
+        if self.cache is not None:
+            recalled = self.cache.get(data_item)
+        elif self.dedup:
+            recalled = self.memo.get(data_item)
+        if recalled is None and self.memo_store is not None:
+            stored = self.memo_store.get(data_item)
+            if stored is not None:
+                results, review_log, items, check = stored
+                self.keep(data_item, results, review_log, items)
+                recalled = results, review_log
+        return recalled
+
+    def remember(self, data_item, rowdict, review_log, items):
+        """
+        Keep the results of data_item, which depended on the rules for items.
+        """
+        results = {column: rowdict[column] for column in self.result_columns
+                   if column in rowdict}
+        if self.memo_store is not None:
+            self.memo_store.put(data_item, results, review_log, items)
+        self.keep(data_item, results, review_log, items)
+
+    def keep(self, data_item, results, review_log, items):
+        """
+        Keep results for the rest of this run and, if cached, the next one.
+        """
+        if self.cache is not None:
+            self.cache.put(data_item, results, review_log, items)
+        elif self.dedup:
+            self.memo[data_item] = results, review_log
+
+    def save(self):
+        """
+        Write the result cache and memo store, if any, once all rows are
+        normalized.
+        """
+        if self.cache is not None:
+            self.cache.save()
+        if self.memo_store is not None:
+            self.memo_store.save()
+
+    def process_chunk(self, chunk):
+        """
+        Normalize a list of (index, rowdict) pairs in a worker process.
+        """
+        return [(index, *self.process(index, rowdict)) for index, rowdict in chunk]
+
+
+def iter_stage_rows(stage, rows, workers=1, worker_args=()):
+    """
+    Normalize a stream of (index, rowdict) pairs with stage, a RuleStage,
+    yielding each row once it is normalized.
+
+    If workers is more than 1, rows are normalized in that many processes by
+    stages built from worker_args, and their review events are logged to
+    stage in row order. Otherwise stage's results are saved once rows run out.
+    """
+    if workers > 1:
+        for index, rowdict, review_log in iter_sharded(rows, type(stage), worker_args, workers):
+            stage.replay(review_log, stage.weight(rowdict))
+            yield index, rowdict
+    else:
+        for index, rowdict in rows:
+            rowdict, review_log = stage.process(index, rowdict)
+            yield index, rowdict
+        stage.save()
+
+
+def add_stage_arguments(parser, cache=True):
+    """
+    Add the options shared by the normalization scripts to an argparse parser:
+    --dedup, --compress or --columnar, --memo and, if cache is True,
+    --incremental and --no-cache.
+    """
+    parser.add_argument("--dedup", "-d", action="store_true",
+                        help="Normalize each distinct value only once")
+    output_format = parser.add_mutually_exclusive_group()
+    output_format.add_argument("--compress", "-z", choices=["gz", "xz", "zst"],
+                               help="Compress the normalized data with gzip, xz or zstandard")
+    output_format.add_argument("--columnar", "-b", action="store_true",
+                               help="Write the normalized data in the binary columnar format")
+    if cache:
+        parser.add_argument("--incremental", "-n", action="store_true",
+                            help="Reuse the last run's results for values whose rules are "
+                                 "unchanged")
+        parser.add_argument("--no-cache", action="store_true",
+                            help="Normalize even if an earlier run had the same inputs")
+    parser.add_argument("--memo", "-m",
+                        help="SQLite file to reuse and save results for each value in")
+
+
+def next_index(dict_with_index, allocator=None):
     """
     Find next available index in a dict and returns it.
+
+    Takes the index from allocator instead of scanning the keys if one is given.
     """
+    if allocator is not None:
+        return allocator.allocate()
     if len(dict_with_index.keys()) == 0:
         return 0
     else:
@@ -147,10 +990,14 @@ def next_index(dict_with_index):
         return test_index
 
 
-def lookup(invalid_item, review_dict, reference_dict, mode):
+def lookup(invalid_item, review_dict, reference_dict, mode, rule_index=None):
     """
     Finds index of a character if it is logged in either reference or review.
+
+    Uses rule_index instead of scanning both dicts if one is given.
     """
+    if rule_index is not None:
+        return rule_index.lookup(invalid_item)
     if mode == "char":
         mode = "character"
     source, location = None, None
@@ -203,9 +1050,11 @@ def take_action(reference_dict, invalid_item, data_item, index, delimiters):
             data_item = re.sub(target_regex, r"\1\2", data_item)
     return data_item
 
-def update_reference(review_dict, reference_dict, allowed_items):
+def update_reference(review_dict, reference_dict, allowed_items, rule_index=None):
     """
     Moves review_dict rows in which an action has been taken to reference_dict.
+
+    Keeps rule_index in sync with the moved rows if one is given.
     """
     if len(review_dict.keys()) != 0:
         indices_to_transfer = []
@@ -213,11 +1062,19 @@ def update_reference(review_dict, reference_dict, allowed_items):
             if check_action(rowdict) is not None:
                 indices_to_transfer.append(index)
         for index in indices_to_transfer:
-            new_index = next_index(reference_dict)
+            if rule_index is not None:
+                new_index = next_index(reference_dict, rule_index.allocators["reference"])
+            else:
+                new_index = next_index(reference_dict)
             row = review_dict[index].copy()
             row["index"] = new_index
             reference_dict[new_index] = row
             del review_dict[index]
+            if rule_index is not None:
+                rule_index.allocators["review"].release(index)
+                item = row[rule_index.column]
+                rule_index.remove("review", item, index)
+                rule_index.add("reference", item, new_index)
     if len(reference_dict.keys()) != 0:
         for index, rowdict in reference_dict.items():
             if rowdict["allow"] != "":
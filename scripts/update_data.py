@@ -1,11 +1,11 @@
 import os
 import re
 import sys
-from converter import dict2TSV, TSV2dict
+from converter import dict2TSV, TSV2table, resolve_path
 
 
 def make_source(normalized_data_path, target_column):
-    datadict = TSV2dict(normalized_data_path)
+    datadict = TSV2table(normalized_data_path)
     source = {}
     for index, rowdict in datadict.items():
         normalized_string = rowdict[f"phrase_normalized_{target_column}"]
@@ -50,14 +50,14 @@ def update_data(input, source, target_column):
 def main():
     style = sys.argv[1]
     target_column = sys.argv[2]
-    normalized_data = os.path.join(style, "output_files", f"p_norm_{style}.tsv")
+    normalized_data = resolve_path(os.path.join(style, "output_files", f"p_norm_{style}.tsv"))
     source = make_source(normalized_data, target_column)
     data_collection = {}
     invalid_total, updated_total, accepted_total, remaining_total, input_total = 0, 0, 0, 0, 0
     for group in ["bcell", "tcell", "mhc_elution"]:
         input_path = os.path.join(style, "input_files", "iedb_data", f"{group}_curation_{style}.tsv")
         output_dir = os.path.join(style, "output_files", "iedb_data")
-        input = TSV2dict(input_path)
+        input = TSV2table(input_path)
         invalid, updated, accepted, remaining, input_count = update_data(
                                                           input,
                                                           source,
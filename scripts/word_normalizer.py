@@ -1,8 +1,18 @@
+import argparse
 import os
 import re
 import sys
 import toolkit as tk
-from converter import TSV2dict, dict2TSV
+from converter import TSV2table, data_path, dict2TSV, resolve_path
+
+
+approved_words = [
+    "are",
+    "is",
+    "than",
+    r"\d+"
+]
+delimiters = [",", ".", "-", " ", "(", ")", ":", ";"]
 
 
 def build_regex_from_list(list_of_strings):
@@ -16,6 +26,9 @@ def build_regex_from_list(list_of_strings):
     return regex
 
 
+word_regex = build_regex_from_list(approved_words)
+
+
 def identify_invalid_words(string):
     """
     Return a set of invalid words found a string.
@@ -43,94 +56,241 @@ def make_word_set(string, delimiters):
     return word_set
 
 
-def normalize_words(style, data_file, original_column, review_file, reference_file):
+def normalize_words(style, data_file, original_column, review_file, reference_file,
+                    dedup=False, weight_column=None, compress=None, columnar=False,
+                    cache_dir=None, stage_cache_dir=None, memo_path=None):
     """
     Performs word normalization on target_column in data_file.
 
-    Reads or creates reference & review dicts, attempts to replace or remove
-    invalid words in those data items if possible, and if no replacement has
-    been specified, adds them to review file for manual review.
+    Reads or creates reference & review dicts, normalizes the data with
+    normalize_word_data, and writes the output, review and reference files.
+    If compress is "gz", "xz" or "zst", the output file is compressed with it;
+    if columnar is True, it is written in the binary columnar format instead.
+    See iter_normalize_words for cache_dir and memo_path.
+
+    If stage_cache_dir is given, the output, review and reference files are
+    kept in a tk.StageCache there, and restored from it instead of normalizing
+    when the data file, sheets and settings match an earlier run.
+    """
+    output_path = data_path(os.path.join(style, "output_files", f"w_norm_{style}.tsv"),
+                            compress, columnar)
+    outputs = [output_path, review_file, reference_file]
+    if stage_cache_dir is not None:
+        stage_cache = tk.StageCache(stage_cache_dir)
+        key = stage_cache.key("word", [data_file, review_file, reference_file], outputs,
+                              (original_column, dedup, weight_column), [sys.modules[__name__]])
+        if stage_cache.restore(key, outputs):
+            return
+    data_dict = TSV2table(data_file)
+    review_dict, reference_dict = tk.load_sheets(review_file, reference_file)
+    data_dict, review_dict, reference_dict = normalize_word_data(style,
+                                                                 data_dict,
+                                                                 original_column,
+                                                                 review_dict,
+                                                                 reference_dict,
+                                                                 dedup,
+                                                                 weight_column,
+                                                                 cache_dir=cache_dir,
+                                                                 memo_path=memo_path)
+    dict2TSV(data_dict, output_path)
+    tk.write_sheets(review_dict, review_file, reference_dict, reference_file)
+    if stage_cache_dir is not None:
+        stage_cache.store(key, outputs)
+
+
+def normalize_word_data(style, data_dict, original_column, review_dict, reference_dict,
+                        dedup=False, weight_column=None, workers=1, cache_dir=None,
+                        memo_path=None):
     """
-    data_dict = TSV2dict(data_file)
-    target_column = f"char_normalized_{original_column}"
-    new_column = f"word_normalized_{original_column}"
-    allowed_words = set()
-    if os.path.isfile(review_file):
-        review_dict = TSV2dict(review_file)
-    else:
-        review_dict = {}
-    if os.path.isfile(reference_file):
-        reference_dict = TSV2dict(reference_file)
-    else:
-        reference_dict = {}
-    review_dict, reference_dict, allowed_words = tk.update_reference(review_dict, reference_dict, allowed_words)
-    review_dict = tk.clean_occurrences(review_dict)
-    for index, rowdict in data_dict.items():
+    Performs word normalization on the char-normalized column in data_dict.
+
+    See iter_normalize_words for the arguments.
+    Returns data_dict, review_dict and reference_dict.
+    """
+    rows = iter_normalize_words(style,
+                                data_dict.items(),
+                                original_column,
+                                review_dict,
+                                reference_dict,
+                                dedup,
+                                weight_column,
+                                workers,
+                                cache_dir,
+                                memo_path)
+    for index, rowdict in rows:
+        data_dict[index] = rowdict
+    return data_dict, review_dict, reference_dict
+
+
+class WordStage(tk.RuleStage):
+    """
+    Word normalization rules compiled for normalizing one row at a time.
+
+    Takes review_dict and reference_dict as loaded from the sheets, moves
+    actioned review rows to reference_dict and compiles the reference rules.
+    process normalizes a row and logs its unknown words to review_dict.
+    If cache_dir is given, results are kept there in a tk.ResultCache, and if
+    memo_path is given, in a tk.MemoStore in that file.
+    """
+
+    def __init__(self, style, original_column, review_dict, reference_dict, dedup=False,
+                 weight_column=None, cache_dir=None, memo_path=None):
+        super().__init__("word", style, dedup, weight_column)
+        self.original_column = original_column
+        self.target_column = f"char_normalized_{original_column}"
+        self.new_column = f"word_normalized_{original_column}"
+        self.allowed_words = set()
+        self.rule_index = tk.RuleIndex(review_dict, reference_dict, "word")
+        review_dict, reference_dict, self.allowed_words = tk.update_reference(review_dict,
+                                                                              reference_dict,
+                                                                              self.allowed_words,
+                                                                              self.rule_index)
+        self.review_dict = tk.clean_occurrences(review_dict)
+        self.reference_dict = reference_dict
+        self.program = tk.RuleProgram(reference_dict, "word", delimiters)
+        self.result_columns = ["word_validation", self.new_column, "word_distance_score"]
+        if cache_dir is not None or memo_path is not None:
+            settings = ("word", style, original_column,
+                        tk.source_digest(sys.modules[__name__], tk))
+            rules = tk.rule_summaries(self.reference_dict, self.rule_index, self.allowed_words)
+            self.open_results(original_column, settings, rules, cache_dir, memo_path)
+
+    def process(self, index, rowdict):
+        """
+        Normalize the char-normalized column of rowdict and log its unknown words.
+
+        Returns rowdict and the review events it logged.
+        """
+        target_column = self.target_column
+        new_column = self.new_column
         data_item = rowdict[target_column]
-        m = re.match(r"!\s.+\s!", data_item)
-        if m:
+        weight = self.weight(rowdict)
+        recalled = self.recall(data_item)
+        if recalled is not None:
+            results, review_log = recalled
+            rowdict.update(results)
+            self.replay(review_log, weight)
+            return rowdict, review_log
+        review_log = []
+        items = set()
+        stopped = re.match(r"!\s.+\s!", data_item)
+        if not stopped and self.style == "data_loc":
+            url = re.fullmatch(r"https:\/\/hla-ligand-atlas.org\/peptide\/[a-zA-Z]+", data_item)
+        else:
+            url = None
+        if stopped:
             rowdict["word_validation"] = "stopped"
             rowdict[new_column] = data_item
-            continue
-        if style == "data_loc":
-            m = re.fullmatch(r"https:\/\/hla-ligand-atlas.org\/peptide\/[a-zA-Z]+", data_item)
-            if m:
-                rowdict["word_validation"] = "pass"
-                rowdict[new_column] = data_item
-                rowdict = tk.evaluate_ld(rowdict,
-                                         "word",
-                                         target_column,
-                                         new_column)
-                continue
-        invalid_words = identify_invalid_words(data_item)
-        rowdict["word_validation"] = tk.validate(invalid_words, "string")
-        if tk.validate(invalid_words, "boolean"):
-            rowdict[new_column] = data_item.strip()
+        elif url:
+            rowdict["word_validation"] = "pass"
+            rowdict[new_column] = data_item
+            rowdict = tk.evaluate_ld(rowdict,
+                                     "word",
+                                     target_column,
+                                     new_column)
         else:
-            review_dict, reference_dict, data_item, allowed_words = tk.handle_invalid_items(
-                style,
-                invalid_words,
-                review_dict,
-                reference_dict,
-                "word",
-                data_item,
-                allowed_words,
-                delimiters
-            )
             invalid_words = identify_invalid_words(data_item)
-            for word in invalid_words.copy():
-                if word in allowed_words:
-                    invalid_words.remove(word)
+            items.update(invalid_words)
             rowdict["word_validation"] = tk.validate(invalid_words, "string")
             if tk.validate(invalid_words, "boolean"):
                 rowdict[new_column] = data_item.strip()
             else:
-                rowdict[new_column] = f"! Invalid words: {sorted(invalid_words)} !"
-        rowdict = tk.evaluate_ld(rowdict,
-                                 "word",
-                                 target_column,
-                                 new_column)
+                self.review_dict, self.reference_dict, data_item, self.allowed_words = \
+                    tk.handle_invalid_items(
+                        self.style,
+                        invalid_words,
+                        self.review_dict,
+                        self.reference_dict,
+                        "word",
+                        data_item,
+                        self.allowed_words,
+                        delimiters,
+                        self.rule_index,
+                        self.program,
+                        review_log,
+                        weight
+                    )
+                invalid_words = identify_invalid_words(data_item)
+                items.update(invalid_words)
+                for word in invalid_words.copy():
+                    if word in self.allowed_words:
+                        invalid_words.remove(word)
+                rowdict["word_validation"] = tk.validate(invalid_words, "string")
+                if tk.validate(invalid_words, "boolean"):
+                    rowdict[new_column] = data_item.strip()
+                else:
+                    rowdict[new_column] = f"! Invalid words: {sorted(invalid_words)} !"
+            rowdict = tk.evaluate_ld(rowdict,
+                                     "word",
+                                     target_column,
+                                     new_column)
+        self.remember(rowdict[target_column], rowdict, review_log, items)
+        return rowdict, review_log
 
-    output_path = os.path.join(style, "output_files", f"w_norm_{style}.tsv")
-    dict2TSV(data_dict, output_path)
-    if len(review_dict.keys()) != 0:
-        dict2TSV(review_dict, review_file)
-    if len(reference_dict.keys()) != 0:
-        dict2TSV(reference_dict, reference_file)
 
+def iter_normalize_words(style, rows, original_column, review_dict, reference_dict,
+                         dedup=False, weight_column=None, workers=1, cache_dir=None,
+                         memo_path=None):
+    """
+    Performs word normalization on the char-normalized column in a stream of rows.
 
-if __name__ == "__main__":
-    style = sys.argv[1]
-    input_file = os.path.join(style, "output_files", f"c_norm_{style}.tsv")
-    original_column = sys.argv[2]
+    Attempts to replace or remove invalid words in those data items if
+    possible, and if no replacement has been specified, adds them to
+    review_dict for manual review.
+
+    rows is an iterable of (index, rowdict) pairs, each of which is yielded as
+    soon as its row is normalized. review_dict and reference_dict are updated
+    in place.
+
+    If dedup is True, each distinct data item is normalized once and its result
+    is reused for repeats, which are still counted in the review file.
+
+    If weight_column is given, each row counts as that column's value of
+    occurrences in the review file, e.g., for a table of distinct values and
+    their counts.
+
+    If workers is more than 1, rows are normalized in that many processes and
+    their review events are logged here in row order, so review_dict ends up
+    the same as in a single-process run.
+
+    If cache_dir is given, each distinct data item's results are kept in a
+    file there, and the next run normalizes again only the data items with
+    words whose reference rules have changed, reusing the rest. This needs a
+    single process.
+
+    If memo_path is given, results are also looked up in and added to an
+    SQLite database there, keyed by style, data item and a hash of all the
+    rules, so data items normalized by any earlier run with the same rules
+    are not normalized again. This also needs a single process.
+    """
+    if workers > 1 and (cache_dir is not None or memo_path is not None):
+        raise ValueError("Results can only be cached when normalizing in one process.")
+    stage = WordStage(style, original_column, review_dict, reference_dict, dedup, weight_column,
+                      cache_dir, memo_path)
+    worker_args = (style, original_column, {}, stage.reference_dict, dedup, weight_column)
+    yield from tk.iter_stage_rows(stage, rows, workers, worker_args)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("style",
+                        help="Data style, e.g., age or data_loc")
+    parser.add_argument("column",
+                        help="Name of the starting column, e.g., h_age")
+    parser.add_argument("--weights", "-w",
+                        help="Column holding the number of occurrences each row stands for")
+    tk.add_stage_arguments(parser)
+    args = parser.parse_args()
+    style = args.style
+    input_file = resolve_path(os.path.join(style, "output_files", f"c_norm_{style}.tsv"))
     review = os.path.join(style, "output_files", "word_review.tsv")
     reference = os.path.join(style, "output_files", "word_reference.tsv")
-    approved_words = [
-        "are",
-        "is",
-        "than",
-        r"\d+"
-    ]
-    delimiters = [",", ".", "-", " ", "(", ")", ":", ";"]
-    word_regex = build_regex_from_list(approved_words)
-    normalize_words(style, input_file, original_column, review, reference)
+    cache_dir = os.path.join(style, "output_files", "cache")
+    normalize_words(style, input_file, args.column, review, reference,
+                    args.dedup, args.weights, args.compress, args.columnar,
+                    cache_dir if args.incremental else None,
+                    None if args.no_cache else cache_dir, args.memo)
+
+
+if __name__ == "__main__":
+    main()